@@ -3,9 +3,23 @@ import requests
 import pandas as pd
 from datetime import datetime, timedelta
 import calendar
+import functools
+import gzip
+import hashlib
+import json
+import shutil
+import sqlite3
+from collections import Counter, namedtuple
+from contextlib import contextmanager
 import io
+import os
+import random
+import threading
+import uuid
+import time
 import pytz
 import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from bs4 import BeautifulSoup 
 import re 
 import numpy as np # NumPyを追加
@@ -40,6 +54,13 @@ DATA_TYPES = {
     }
 }
 
+# SHOWROOMへのリクエストで共通に使うヘッダー
+SR_REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0.4896.127 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
+    'Accept-Language': 'ja,en-US;q=0.9,en;q=0.8',
+}
+
 # 処理対象ライバーファイルのURL
 TARGET_LIVER_FILE_URL = "https://mksoul-pro.com/showroom/file/shiharai-taishou.csv"
 
@@ -47,20 +68,602 @@ TARGET_LIVER_FILE_URL = "https://mksoul-pro.com/showroom/file/shiharai-taishou.c
 JST = pytz.timezone('Asia/Tokyo')
 
 # --- 設定ロードと認証 ---
+# オーガナイザーアカウント (表示名, ログインID, Cookie文字列)
+OrganizerAccount = namedtuple('OrganizerAccount', ['name', 'login_id', 'cookie_string'])
+
+
+def load_organizer_accounts(showroom_secrets):
+    """
+    secrets の [showroom] からオーガナイザーアカウントの一覧を作る
+    従来の auth_cookie_string / login_id を先頭のアカウントとし、
+    [[showroom.accounts]] (name, login_id, auth_cookie_string) に追加のアカウントを列挙できる
+    """
+    accounts = []
+    for conf in [showroom_secrets] + list(showroom_secrets.get("accounts", [])):
+        login_id = str(conf["login_id"])
+        accounts.append(OrganizerAccount(str(conf.get("name", login_id)), login_id, conf["auth_cookie_string"]))
+    names = [account.name for account in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError(f"アカウント名が重複しています: {names}")
+    return accounts
+
+
 try:
-    # オーガナイザーCookieを取得
-    AUTH_COOKIE_STRING = st.secrets["showroom"]["auth_cookie_string"]
-    LOGIN_ID = st.secrets["showroom"]["login_id"]
+    # オーガナイザーCookieを取得 (先頭のアカウントを既定のアカウントとする)
+    ORGANIZER_ACCOUNTS = load_organizer_accounts(st.secrets["showroom"])
+    AUTH_COOKIE_STRING = ORGANIZER_ACCOUNTS[0].cookie_string
+    LOGIN_ID = ORGANIZER_ACCOUNTS[0].login_id
     
 except KeyError as e:
     AUTH_COOKIE_STRING = "DUMMY"
     LOGIN_ID = "DUMMY"
     st.error(f"🚨 認証設定がされていません。`.streamlit/secrets.toml`を確認してください。不足: {e}")
     st.stop()
+except ValueError as e:
+    st.error(f"🚨 オーガナイザーアカウントの設定が不正です。`.streamlit/secrets.toml`を確認してください。{e}")
+    st.stop()
+
+
+# --- ダウンロードサイズ上限 (secrets の [limits] で上書き可能) ---
+try:
+    _LIMITS = dict(st.secrets.get("limits", {}))
+except Exception:
+    _LIMITS = {}
+# SHOWROOM 請求書ページ (HTML) の最大サイズ
+MAX_HTML_BYTES = int(_LIMITS.get("max_html_bytes", 16 * 1024 * 1024))
+# 履歴Excel (uriage_*.xlsx) の最大サイズ
+MAX_XLSX_BYTES = int(_LIMITS.get("max_xlsx_bytes", 8 * 1024 * 1024))
+# ストリーミング取得時のチャンクサイズ
+DOWNLOAD_CHUNK_SIZE = int(_LIMITS.get("download_chunk_size", 64 * 1024))
+
+
+# --- ストリーミング取得とメモリ使用量の計測 ---
+
+class ResponseTooLargeError(Exception):
+    """レスポンスが設定されたサイズ上限を超えた場合に送出する"""
+
+
+# スレッドごとに再利用するダウンロードバッファ
+_download_buffers = threading.local()
+
+
+def download_to_buffer(http, url, max_bytes, response_info=None, cancel=None, **kwargs):
+    """
+    URLをストリーミングで取得し、スレッドごとに再利用するバッファへ書き込む
+    サイズ上限 (max_bytes) を超えた時点で ResponseTooLargeError を送出する
+    cancel: 中止フラグ (threading.Event)。立っていればチャンクを受け取るたびに確認して FetchCancelled を送出する
+    response_info: 辞書を渡すと、ステータスコードとレスポンスヘッダーを格納する
+                   (条件付き取得で 304 が返った場合は本文を読まずに (None, エンコーディング) を返す)
+    戻り値: (先頭にシーク済みの io.BytesIO, レスポンスのエンコーディング)
+    """
+    buf = getattr(_download_buffers, 'buffer', None)
+    if buf is None:
+        buf = io.BytesIO()
+        _download_buffers.buffer = buf
+    buf.seek(0)
+    buf.truncate(0)
+    if cancel is not None and cancel.is_set():
+        raise FetchCancelled(f"{url}: 並行した取得が先に終わったため開始しませんでした")
+
+    with http.get(url, stream=True, **kwargs) as response:
+        response.raise_for_status()
+        if response_info is not None:
+            response_info['status_code'] = response.status_code
+            response_info['headers'] = dict(response.headers)
+            if response.status_code == 304:
+                return None, response.encoding
+
+        content_length = response.headers.get('Content-Length', '')
+        if content_length.isdigit() and int(content_length) > max_bytes:
+            raise ResponseTooLargeError(f"{url}: Content-Length {int(content_length):,} バイトが上限 {max_bytes:,} バイトを超えています")
+
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            if cancel is not None and cancel.is_set():
+                buf.seek(0)
+                buf.truncate(0)
+                raise FetchCancelled(f"{url}: 並行した取得が先に終わったため中止しました")
+            if buf.tell() + len(chunk) > max_bytes:
+                buf.seek(0)
+                buf.truncate(0)
+                raise ResponseTooLargeError(f"{url}: レスポンスが上限 {max_bytes:,} バイトを超えました")
+            buf.write(chunk)
+        encoding = response.encoding
+        if encoding is None:
+            # charset 指定がない場合は response.text と同様に本文から推定する (apparent_encoding 相当)
+            encoding = requests.compat.chardet.detect(buf.getvalue())['encoding']
+
+    buf.seek(0)
+    return buf, encoding
+
+
+def release_download_buffer():
+    """再利用バッファの中身を破棄する (大きなレスポンスの後にメモリを返すため)"""
+    buf = getattr(_download_buffers, 'buffer', None)
+    if buf is not None:
+        buf.seek(0)
+        buf.truncate(0)
+
+
+def get_memory_usage_mb():
+    """現在のプロセスの常駐メモリ (RSS, MB) を返す。取得できない環境では最大RSSで代用する"""
+    try:
+        with open('/proc/self/statm') as f:
+            rss_pages = int(f.read().split()[1])
+        return rss_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except Exception:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except Exception:
+        return None
+
+
+def log_memory_usage(stage):
+    """ステージ名付きでメモリ使用量をログ出力し、値 (MB) を返す"""
+    rss_mb = get_memory_usage_mb()
+    if rss_mb is not None:
+        logging.info(f"[メモリ] {stage}: RSS {rss_mb:.1f} MB")
+    return rss_mb
+
+
+# --- 取得ポリシー (タイムアウト・再試行・ヘッジ・実行全体の期限) ---
+class FetchDeadlineExceeded(Exception):
+    """実行全体の期限を過ぎたため取得を打ち切った場合に送出する"""
+
+
+class FetchCancelled(Exception):
+    """ヘッジで並行した試行のうち、もう一方が先に終わったため読み込みを中止した場合に送出する"""
+
+
+class FetchPolicy:
+    """
+    1種類の取得先に対するタイムアウト・再試行の方針
+    - connect_timeout / read_timeout: 接続・読み取りのタイムアウト (秒)
+    - max_attempts: 一時的な失敗 (接続エラー・タイムアウト・429/5xx) を含めた最大試行回数
+    - backoff_base / backoff_max: 再試行の待ち時間 (フルジッター付きの指数バックオフ) の基準値と上限 (秒)
+    - hedge_after: この秒数以内に応答がなければ同じ取得をもう1本並行して投げ、先に終わった方を使う (None で無効)
+    """
+
+    def __init__(self, connect_timeout=5.0, read_timeout=30.0, max_attempts=3, backoff_base=0.5, backoff_max=8.0, hedge_after=None):
+        self.connect_timeout = float(connect_timeout)
+        self.read_timeout = float(read_timeout)
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.hedge_after = float(hedge_after) if hedge_after else None
+
+    @classmethod
+    def from_settings(cls, settings, **defaults):
+        """secrets の設定値で既定値を上書きしたポリシーを作る"""
+        params = dict(defaults)
+        params.update({k: v for k, v in dict(settings).items() if k in (
+            'connect_timeout', 'read_timeout', 'max_attempts', 'backoff_base', 'backoff_max', 'hedge_after'
+        )})
+        return cls(**params)
+
+    def timeout(self, deadline=None):
+        """(接続, 読み取り) のタイムアウト。実行全体の期限が近ければ残り時間に切り詰める"""
+        if deadline is None:
+            return (self.connect_timeout, self.read_timeout)
+        remaining = deadline.remaining()
+        if remaining <= 0:
+            raise deadline.exceeded(f"実行全体の期限 ({deadline.seconds:g}秒) を過ぎたため、取得を打ち切りました")
+        return (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+
+    def backoff_delay(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+
+class RunDeadline:
+    """
+    1回の実行全体の期限 (seconds が 0 または None なら期限なし)
+    hit: 期限を理由に取得・処理を打ち切ったか (True なら実行結果は一部のみ)
+    """
+
+    def __init__(self, seconds):
+        self.seconds = float(seconds) if seconds else None
+        self._expires_at = time.monotonic() + self.seconds if self.seconds else None
+        self.hit = False
+
+    def exceeded(self, message):
+        """期限による打ち切りを記録し、送出する FetchDeadlineExceeded を返す"""
+        self.hit = True
+        return FetchDeadlineExceeded(message)
+
+    def remaining(self):
+        if self._expires_at is None:
+            return float('inf')
+        return max(0.0, self._expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+try:
+    _FETCH_POLICY_SETTINGS = dict(st.secrets.get("fetch_policy", {}))
+except Exception:
+    _FETCH_POLICY_SETTINGS = {}
+# SHOWROOM 請求書ページ / 履歴Excel の取得ポリシー (secrets の [fetch_policy.showroom] / [fetch_policy.workbook] で上書き可能)
+# ヘッジ (同じ取得の並行再送) は既定では無効。有効にする場合は hedge_after (秒) を設定する
+SHOWROOM_FETCH_POLICY = FetchPolicy.from_settings(_FETCH_POLICY_SETTINGS.get("showroom", {}), read_timeout=30.0)
+WORKBOOK_FETCH_POLICY = FetchPolicy.from_settings(_FETCH_POLICY_SETTINGS.get("workbook", {}), read_timeout=15.0)
+# ヘッジした試行を実行するスレッドの上限 (プロセス全体で共有する)
+HEDGE_MAX_WORKERS = int(_FETCH_POLICY_SETTINGS.get("hedge_max_workers", 8))
+# 1回の実行 (アカウント単位) 全体の期限 (秒)。期限を過ぎると残りの取得を打ち切り、結果を「一部のみ」として扱う
+RUN_DEADLINE_SECONDS = float(_FETCH_POLICY_SETTINGS.get("run_deadline_seconds", 1800))
+
+
+def is_retryable_fetch_error(error):
+    """再試行で回復し得る一時的な失敗か (接続エラー・タイムアウト・429/5xx)"""
+    if isinstance(error, requests.exceptions.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+        return status is not None and (status == 429 or status >= 500)
+    return isinstance(error, (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+    ))
+
+
+@st.cache_resource
+def get_hedge_executor():
+    """ヘッジした試行を実行するスレッドプール (プロセスに1つ、取得のたびには作らない)"""
+    return ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="hedged-fetch")
+
+
+def _hedged_call(policy, attempt_fn, timeout):
+    """
+    hedge_after 秒以内に終わらなければ同じ試行をもう1本並行して投げ、先に成功した結果を返す
+    各試行には中止フラグ (threading.Event) を渡し、結果が決まった時点で残りの試行に中止を伝える
+    """
+    if policy.hedge_after is None:
+        return attempt_fn(timeout, None)
+    executor = get_hedge_executor()
+    cancels = [threading.Event()]
+    futures = [executor.submit(attempt_fn, timeout, cancels[0])]
+    try:
+        done, _ = wait(futures, timeout=policy.hedge_after, return_when=FIRST_COMPLETED)
+        if not done:
+            logging.info(f"応答が {policy.hedge_after:g}秒以内になかったため、同じ取得を並行して再送します")
+            cancels.append(threading.Event())
+            futures.append(executor.submit(attempt_fn, timeout, cancels[-1]))
+        errors = []
+        for future in as_completed(futures):
+            try:
+                return future.result()
+            except Exception as e:
+                errors.append(e)
+        raise errors[0]
+    finally:
+        # 遅い方の試行の終了は待たない。中止フラグを立てると、次のチャンクを受け取った時点で FetchCancelled で終わる
+        # (読み取りタイムアウトは1回の読み込みごとの上限のため、少しずつ届く応答はフラグがないと終わらない)
+        for cancel in cancels:
+            cancel.set()
+
+
+def call_with_policy(policy, attempt_fn, deadline=None, label=""):
+    """
+    attempt_fn(timeout, cancel) を取得ポリシーに従って実行し、その戻り値を返す
+    一時的な失敗はジッター付きの指数バックオフで再試行し、実行全体の期限を過ぎたら FetchDeadlineExceeded を送出する
+    attempt_fn は並行して呼ばれることがあるため、スレッドごとのバッファを呼び出し側へ返さないこと
+    cancel はヘッジ時の中止フラグ (ヘッジしない場合は None)。download_to_buffer にそのまま渡す
+    """
+    for attempt in range(policy.max_attempts):
+        timeout = policy.timeout(deadline)
+        try:
+            return _hedged_call(policy, attempt_fn, timeout)
+        except Exception as e:
+            if not is_retryable_fetch_error(e) or attempt + 1 >= policy.max_attempts:
+                raise
+            delay = policy.backoff_delay(attempt)
+            if deadline is not None and deadline.remaining() <= delay:
+                # 期限そのものはまだ過ぎていなくても、再試行できないため打ち切りとして記録する
+                raise deadline.exceeded(f"実行全体の期限が近いため、{label} の再試行を打ち切りました: {e}") from e
+            logging.info(f"{label} の取得に失敗したため {delay:.1f}秒後に再試行します ({attempt + 1}/{policy.max_attempts}): {e}")
+            time.sleep(delay)
+
+
+# --- プロセス共有キャッシュ (同一リクエストの単一フライト化) ---
+# SHOWROOMページ・履歴Excelの取得結果をセッション間で共有する有効期間 (秒)
+SHARED_FETCH_TTL_SECONDS = int(_LIMITS.get("shared_fetch_ttl_seconds", 300))
+
+
+class _InflightCall:
+    """実行中の取得処理 (待ち合わせ用のイベントと結果を保持する)"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlightCache:
+    """
+    プロセス全体で共有する結果キャッシュ
+    同じキーへの同時リクエストは1回の取得処理を待ち合わせ、その結果を共有する
+    None (取得失敗) と例外はキャッシュせず、待ち合わせ中の呼び出しにのみ共有する
+    """
+
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._results = {}   # key -> (保存時刻, 値)
+        self._inflight = {}  # key -> _InflightCall
+
+    def get_or_compute(self, key, compute):
+        """
+        キャッシュ済みまたは実行中の結果があればそれを、なければ compute() を実行して返す
+        戻り値: (値, shared) shared は他の呼び出しの結果を再利用した場合 True
+        """
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl_seconds:
+                return entry[1], True
+            call = self._inflight.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _InflightCall()
+                self._inflight[key] = call
+
+        if not is_leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+
+        try:
+            call.value = compute()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+                if call.error is None and call.value is not None:
+                    self._prune_expired()
+                    self._results[key] = (time.monotonic(), call.value)
+            call.event.set()
+        return call.value, False
+
+    def invalidate(self, key):
+        with self._lock:
+            self._results.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def _prune_expired(self):
+        now = time.monotonic()
+        expired = [k for k, (stored_at, _) in self._results.items() if now - stored_at >= self.ttl_seconds]
+        for k in expired:
+            del self._results[k]
+
+
+@st.cache_resource
+def get_shared_fetch_cache():
+    """全セッションで共有する取得キャッシュ (プロセスに1つ)"""
+    return SingleFlightCache(SHARED_FETCH_TTL_SECONDS)
+
+
+def cookie_fingerprint(cookie_string):
+    """Cookie文字列をキャッシュキー用の短いハッシュに変換する (Cookie自体はキーに残さない)"""
+    return hashlib.sha256(str(cookie_string).encode('utf-8')).hexdigest()[:16]
+
+
+# --- 認証の事前確認とサーキットブレーカー ---
+# 認証確認に使うオーガナイザーページ (HEAD / リダイレクト無効で状態のみ確認する)
+SR_AUTH_PROBE_URL = SR_ROOM_SALES_URL
+# 認証確認結果を再利用する期間 (秒)
+AUTH_PROBE_TTL_SECONDS = int(_LIMITS.get("auth_probe_ttl_seconds", 60))
+
+
+class PermanentFetchError(Exception):
+    """再試行しても回復しない失敗 (401/403/429 以外の 4xx)"""
+
+
+class AuthExpiredError(Exception):
+    """認証切れ (Cookieの期限切れ・無効) を検出した場合に送出する"""
+
+
+class AuthCircuitBreaker:
+    """アカウント (Cookie) ごとの認証状態。認証切れを一度検出したら、確認が成功するまで取得を止める"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open = False
+        self.reason = None
+        self.tripped_at = None
+
+    def is_open(self):
+        return self._open
+
+    def trip(self, reason):
+        with self._lock:
+            if not self._open:
+                logging.warning(f"認証切れを検出したため、以降の取得を中止します: {reason}")
+            self._open = True
+            self.reason = reason
+            self.tripped_at = datetime.now(JST)
+
+    def reset(self, confirmed_at=None):
+        """
+        ブレーカーを戻す
+        confirmed_at: 認証確認を始めた日時。認証切れの検出より前の確認結果では戻さない
+        戻り値: 戻した場合 True
+        """
+        with self._lock:
+            if self._open and confirmed_at is not None and self.tripped_at is not None and confirmed_at <= self.tripped_at:
+                return False
+            self._open = False
+            self.reason = None
+            self.tripped_at = None
+            return True
+
+
+@st.cache_resource
+def _get_auth_breaker_registry():
+    """全セッションで共有するサーキットブレーカーの登録表"""
+    return {'lock': threading.Lock(), 'breakers': {}}
+
+
+def get_auth_breaker(cookie_string):
+    """Cookieに対応するサーキットブレーカーを返す (Cookieが更新されれば別のブレーカーになる)"""
+    registry = _get_auth_breaker_registry()
+    key = cookie_fingerprint(cookie_string)
+    with registry['lock']:
+        return registry['breakers'].setdefault(key, AuthCircuitBreaker())
+
+
+@st.cache_resource
+def get_auth_probe_cache():
+    """認証確認結果の共有キャッシュ (同時の確認は1回にまとめる)"""
+    return SingleFlightCache(AUTH_PROBE_TTL_SECONDS)
+
+
+def _probe_auth_uncached(cookie_string):
+    """
+    オーガナイザーページへ本文を取得せずにアクセスし、認証状態を確認する
+    戻り値: (True, 理由) 認証有効 / (False, 理由) 認証切れ。通信エラーは例外として送出する
+    """
+    session = create_authenticated_session(cookie_string, notify=_log_notify)
+    if not session:
+        return (False, "Cookie文字列を解析できませんでした")
+
+    headers = dict(SR_REQUEST_HEADERS, Referer=SR_AUTH_PROBE_URL)
+    # 認証確認は本文を読まないため、読み取りタイムアウトは短く抑える
+    probe_timeout = (SHOWROOM_FETCH_POLICY.connect_timeout, min(SHOWROOM_FETCH_POLICY.read_timeout, 10.0))
+    response = session.head(SR_AUTH_PROBE_URL, headers=headers, allow_redirects=False, timeout=probe_timeout)
+    if response.status_code in (405, 501):
+        # HEAD 非対応の場合は GET (本文は読まない) で代用する
+        with session.get(SR_AUTH_PROBE_URL, headers=headers, allow_redirects=False, stream=True, timeout=probe_timeout) as response:
+            pass
+
+    status = response.status_code
+    if 300 <= status < 400:
+        return (False, f"ログインページへリダイレクトされました (HTTP {status} → {response.headers.get('Location', '')})")
+    if status in (401, 403):
+        return (False, f"HTTP {status}")
+    if 200 <= status < 300:
+        return (True, f"HTTP {status}")
+    raise requests.exceptions.HTTPError(f"認証確認で想定外の応答がありました (HTTP {status})", response=response)
+
+
+def probe_auth(cookie_string):
+    """
+    バッチ実行前の認証確認 (結果は AUTH_PROBE_TTL_SECONDS の間共有される)
+    同じCookieで続けて開始したジョブ (複数アカウントの同時実行・再実行) は、1回の確認結果を再利用する
+    Cookieを更新すると別のキーになるため、古い確認結果が使われることはない
+    戻り値: (True/False/None, 理由)  None は通信エラー等で判定できなかった場合
+    確認結果はサーキットブレーカーにも反映する
+    (確認の後に取得で認証切れを検出していた場合、共有された古い確認結果ではブレーカーを戻さず認証切れとする)
+    """
+    cache = get_auth_probe_cache()
+    key = cookie_fingerprint(cookie_string)
+
+    def probe():
+        probed_at = datetime.now(JST)
+        return _probe_auth_uncached(cookie_string), probed_at
+
+    try:
+        ((ok, reason), probed_at), _ = cache.get_or_compute(key, probe)
+    except Exception as e:
+        logging.warning(f"認証確認ができませんでした: {e}")
+        return (None, f"認証確認ができませんでした: {e}")
+
+    breaker = get_auth_breaker(cookie_string)
+    if not ok:
+        breaker.trip(reason)
+        return (ok, reason)
+    if not breaker.reset(confirmed_at=probed_at):
+        # 次の実行では改めて確認するよう、古い確認結果は破棄する
+        cache.invalidate(key)
+        return (False, f"認証確認の後に認証切れを検出しています: {breaker.reason}")
+    return (ok, reason)
 
 
 # --- 支払額計算関数 (修正済み: 厳密な型チェックを追加) ---
 
+# --- 固定小数点の料率・税率テーブル ---
+# 料率はベーシスポイント (1/10000) の整数で保持し、浮動小数点誤差を避ける
+RATE_BP_SCALE = 10000
+# 個別ランクに応じた基本レート (mk_rank 1, 3, 5, 7, 9, 11 のキーを使用)
+RANK_RATE_BP = {
+    'D': {1: 7500, 3: 7550, 5: 7600, 7: 7650, 9: 7700, 11: 7750},
+    'E': {1: 7250, 3: 7300, 5: 7350, 7: 7400, 9: 7450, 11: 7500},
+    'C': {1: 7750, 3: 7800, 5: 7850, 7: 7900, 9: 7950, 11: 8000},
+    'B': {1: 8000, 3: 8050, 5: 8100, 7: 8150, 9: 8200, 11: 8250},
+    'A': {1: 8250, 3: 8300, 5: 8350, 7: 8400, 9: 8450, 11: 8500},
+    'S': {1: 8500, 3: 8550, 5: 8600, 7: 8650, 9: 8700, 11: 8750},
+    'SS': {1: 8750, 3: 8800, 5: 8850, 7: 8900, 9: 8950, 11: 9000},
+    'SSS': {1: 9000, 3: 9050, 5: 9100, 7: 9150, 9: 9200, 11: 9250},
+}
+# MKランクからレート表のキーへの対応 (1,2 -> 1, 3,4 -> 3, ...)
+MK_RANK_RATE_KEY = {1: 1, 2: 1, 3: 3, 4: 3, 5: 5, 6: 5, 7: 7, 8: 7, 9: 9, 10: 9, 11: 11}
+# プレミアムライブ・タイムチャージの料率
+PAID_LIVE_RATE_BP = 9000
+TIME_CHARGE_RATE_BP = 10000
+# 税率係数 (分子/分母): インボイス登録者は 1.10/1.10、非登録者は 1.08/1.10
+TAX_DENOMINATOR = 110
+TAX_NUMERATOR_REGISTERED = 110
+TAX_NUMERATOR_UNREGISTERED = 108
+# 支払額の丸め方式: 'half_up' (四捨五入、0から遠い側へ) / 'half_even' (銀行丸め) / 'down' (切り捨て)
+PAYOUT_ROUNDING = 'half_up'
+# int64 で (分配額 × 税率分子 × 料率) がオーバーフローしない分配額の上限
+MAX_EXACT_PAYOUT_AMOUNT = (2 ** 63 - 1) // (TAX_NUMERATOR_REGISTERED * RATE_BP_SCALE)
+
+
+def _round_div_int(numerator, denominator, rounding=PAYOUT_ROUNDING):
+    """整数の割り算を指定の丸め方式で整数に丸める (Python int / NumPy int64 配列の両方に対応)"""
+    negative = numerator < 0
+    magnitude = np.abs(numerator) if isinstance(numerator, np.ndarray) else abs(numerator)
+    quotient = magnitude // denominator
+    remainder2 = (magnitude % denominator) * 2
+    if rounding == 'half_up':
+        quotient = quotient + (remainder2 >= denominator)
+    elif rounding == 'half_even':
+        quotient = quotient + ((remainder2 > denominator) | ((remainder2 == denominator) & (quotient % 2 == 1)))
+    elif rounding != 'down':
+        raise ValueError(f"未対応の丸め方式です: {rounding}")
+    if isinstance(numerator, np.ndarray):
+        return np.where(negative, -quotient, quotient).astype(np.int64)
+    return -int(quotient) if negative else int(quotient)
+
+
+def fixed_point_payout(amounts, rate_bp, is_registered, rounding=PAYOUT_ROUNDING):
+    """
+    支払額を整数演算のみで計算する (スカラー・NumPy配列の両方に対応)
+    支払額 = 分配額 × 税率分子 × 料率(bp) / (110 × 10000) を rounding で整数に丸める
+    """
+    if np.ndim(amounts) == 0 and np.ndim(rate_bp) == 0 and np.ndim(is_registered) == 0:
+        tax_numerator = TAX_NUMERATOR_REGISTERED if is_registered else TAX_NUMERATOR_UNREGISTERED
+        return _round_div_int(int(amounts) * tax_numerator * int(rate_bp), TAX_DENOMINATOR * RATE_BP_SCALE, rounding)
+
+    amounts = np.asarray(amounts, dtype=np.int64)
+    if amounts.size and np.abs(amounts).max() > MAX_EXACT_PAYOUT_AMOUNT:
+        raise OverflowError(f"分配額が整数演算の上限 ({MAX_EXACT_PAYOUT_AMOUNT:,}円) を超えています")
+    tax_numerator = np.where(np.asarray(is_registered, dtype=bool), TAX_NUMERATOR_REGISTERED, TAX_NUMERATOR_UNREGISTERED).astype(np.int64)
+    numerator = amounts * tax_numerator * np.asarray(rate_bp, dtype=np.int64)
+    return _round_div_int(numerator, TAX_DENOMINATOR * RATE_BP_SCALE, rounding)
+
+
+def _to_registered_flag(is_invoice_registered):
+    """★★★ 最終防衛線: 厳格なブール値チェック (文字列 'False' や NaN の文字列化に対応) ★★★"""
+    if isinstance(is_invoice_registered, (bool, np.bool_)):
+        return bool(is_invoice_registered)
+    # 文字列 'False', 'NaN', None などが渡された場合に、PythonでTrueとして扱われるのを防ぐ
+    return not (str(is_invoice_registered).lower().strip() in ('', 'false', '0', 'nan', 'none'))
+
+
+def _to_integer_amount(value):
+    """分配額を整数に変換する (整数でない値は ValueError)"""
+    amount = float(value)
+    if not amount.is_integer():
+        raise ValueError(f"分配額が整数ではありません: {value}")
+    return int(amount)
+
+
 # --- ルーム売上支払想定額計算関数 ---
 def calculate_payment_estimate(individual_rank, mk_rank, individual_revenue, is_invoice_registered):
     """
@@ -71,59 +674,24 @@ def calculate_payment_estimate(individual_rank, mk_rank, individual_revenue, is_
         return "#N/A"
 
     try:
-        # 入力をfloatに変換
-        individual_revenue = float(individual_revenue)
-        # 個別ランクに応じた基本レートの辞書 (mk_rank 1, 3, 5, 7, 9, 11 のキーを使用)
-        rank_rates = {
-            'D': {1: 0.750, 3: 0.755, 5: 0.760, 7: 0.765, 9: 0.770, 11: 0.775},
-            'E': {1: 0.725, 3: 0.730, 5: 0.735, 7: 0.740, 9: 0.745, 11: 0.750},
-            'C': {1: 0.775, 3: 0.780, 5: 0.785, 7: 0.790, 9: 0.795, 11: 0.800},
-            'B': {1: 0.800, 3: 0.805, 5: 0.810, 7: 0.815, 9: 0.820, 11: 0.825},
-            'A': {1: 0.825, 3: 0.830, 5: 0.835, 7: 0.840, 9: 0.845, 11: 0.850},
-            'S': {1: 0.850, 3: 0.855, 5: 0.860, 7: 0.865, 9: 0.870, 11: 0.875},
-            'SS': {1: 0.875, 3: 0.880, 5: 0.885, 7: 0.890, 9: 0.895, 11: 0.900},
-            'SSS': {1: 0.900, 3: 0.905, 5: 0.910, 7: 0.915, 9: 0.920, 11: 0.925},
-        }
+        # 入力を整数 (円) に変換
+        individual_revenue = _to_integer_amount(individual_revenue)
 
         # MKランクに応じてキーを決定 (1,2 -> 1, 3,4 -> 3, ...)
-        if mk_rank in [1, 2]:
-            key = 1
-        elif mk_rank in [3, 4]:
-            key = 3
-        elif mk_rank in [5, 6]:
-            key = 5
-        elif mk_rank in [7, 8]:
-            key = 7
-        elif mk_rank in [9, 10]:
-            key = 9
-        elif mk_rank == 11:
-            key = 11
-        else:
+        key = MK_RANK_RATE_KEY.get(mk_rank)
+        if key is None:
             return "#ERROR_MK"
 
-        # 適用レートの取得
-        rate = rank_rates.get(individual_rank, {}).get(key)
+        # 適用レート (bp) の取得
+        rate_bp = RANK_RATE_BP.get(individual_rank, {}).get(key)
         
-        if rate is None:
+        if rate_bp is None:
             return "#ERROR_RANK"
             
-        # ★★★ 最終防衛線: 厳格なブール値チェック (文字列 'False' や NaN の文字列化に対応) ★★★
-        is_registered = is_invoice_registered
-        if not isinstance(is_registered, bool):
-            # 文字列 'False', 'NaN', None などが渡された場合に、PythonでTrueとして扱われるのを防ぐ
-            is_registered = not (str(is_registered).lower().strip() in ('', 'false', '0', 'nan', 'none'))
-
-
         # インボイス登録有無による計算式の切り替え
-        if is_registered:
-            # インボイス登録者ロジック: (individual_revenue * 1.10 * rate) / 1.10
-            payment_estimate = (individual_revenue * 1.10 * rate) / 1.10
-        else:
-            # インボイス非登録者ロジック (既存): (individual_revenue * 1.08 * rate) / 1.10
-            payment_estimate = (individual_revenue * 1.08 * rate) / 1.10
-        
-        # 結果を小数点以下を四捨五入して整数に丸める
-        return round(payment_estimate) 
+        # 登録者: (individual_revenue * 1.10 * rate) / 1.10, 非登録者: (individual_revenue * 1.08 * rate) / 1.10
+        # 結果は整数演算のまま小数点以下を四捨五入して整数に丸める
+        return fixed_point_payout(individual_revenue, rate_bp, _to_registered_flag(is_invoice_registered))
 
     except Exception:
         return "#ERROR_CALC"
@@ -138,24 +706,11 @@ def calculate_paid_live_payment_estimate(paid_live_amount, is_invoice_registered
         return np.nan
         
     try:
-        # 分配額を数値に変換 
-        individual_revenue = float(paid_live_amount)
+        # 分配額を整数 (円) に変換 
+        individual_revenue = _to_integer_amount(paid_live_amount)
 
-        # ★★★ 最終防衛線: 厳格なブール値チェック ★★★
-        is_registered = is_invoice_registered
-        if not isinstance(is_registered, bool):
-            is_registered = not (str(is_registered).lower().strip() in ('', 'false', '0', 'nan', 'none'))
-        
-        # インボイス登録有無による計算式の切り替え
-        if is_registered:
-            # インボイス登録者ロジック: (individual_revenue * 1.10 * 0.9) / 1.10
-            payment_estimate = (individual_revenue * 1.10 * 0.9) / 1.10
-        else:
-            # インボイス非登録者ロジック (既存): (individual_revenue * 1.08 * 0.9) / 1.10
-            payment_estimate = (individual_revenue * 1.08 * 0.9) / 1.10
-        
-        # 結果を小数点以下を四捨五入して整数に丸める
-        return round(payment_estimate)
+        # 登録者: (individual_revenue * 1.10 * 0.9) / 1.10, 非登録者: (individual_revenue * 1.08 * 0.9) / 1.10
+        return fixed_point_payout(individual_revenue, PAID_LIVE_RATE_BP, _to_registered_flag(is_invoice_registered))
 
     except Exception:
         return "#ERROR_CALC"
@@ -170,29 +725,65 @@ def calculate_time_charge_payment_estimate(time_charge_amount, is_invoice_regist
         return np.nan
 
     try:
-        # 分配額を数値に変換 
-        individual_revenue = float(time_charge_amount)
-        
-        # ★★★ 最終防衛線: 厳格なブール値チェック ★★★
-        is_registered = is_invoice_registered
-        if not isinstance(is_registered, bool):
-            is_registered = not (str(is_registered).lower().strip() in ('', 'false', '0', 'nan', 'none'))
-
-        # インボイス登録有無による計算式の切り替え
-        if is_registered:
-            # インボイス登録者ロジック: (individual_revenue * 1.10 * 1.00) / 1.10
-            payment_estimate = (individual_revenue * 1.10 * 1.00) / 1.10
-        else:
-            # インボイス非登録者ロジック (既存): (individual_revenue * 1.08 * 1.00) / 1.10
-            payment_estimate = (individual_revenue * 1.08 * 1.00) / 1.10
+        # 分配額を整数 (円) に変換 
+        individual_revenue = _to_integer_amount(time_charge_amount)
         
-        # 結果を小数点以下を四捨五入して整数に丸める
-        return round(payment_estimate)
+        # 登録者: (individual_revenue * 1.10 * 1.00) / 1.10, 非登録者: (individual_revenue * 1.08 * 1.00) / 1.10
+        return fixed_point_payout(individual_revenue, TIME_CHARGE_RATE_BP, _to_registered_flag(is_invoice_registered))
 
     except Exception:
         return "#ERROR_CALC"
 
 
+# --- ベクトル化した支払額計算 (DataFrame一括処理用) ---
+
+def room_sales_rate_bp(individual_ranks, mk_ranks):
+    """個別ランク・MKランクの列から適用料率 (bp) の配列を返す。判定できない行は 0 と無効フラグ"""
+    rate_lookup = {(rank, mk): RANK_RATE_BP[rank][key] for rank in RANK_RATE_BP for mk, key in MK_RANK_RATE_KEY.items()}
+    keys = zip(pd.Series(individual_ranks).tolist(), pd.Series(mk_ranks).tolist())
+    rates = np.array([rate_lookup.get((rank, mk), -1) for rank, mk in keys], dtype=np.int64)
+    valid = rates >= 0
+    return np.where(valid, rates, 0), valid
+
+
+def vectorized_payouts(amounts, rate_bp, is_registered, valid=None, rounding=PAYOUT_ROUNDING):
+    """
+    分配額・料率・インボイス登録の列から支払額を一括計算し、Int64 (無効行は <NA>) で返す
+    """
+    amounts_num = pd.to_numeric(pd.Series(amounts), errors='coerce')
+    ok = amounts_num.notna().to_numpy() & (amounts_num.fillna(0) % 1 == 0).to_numpy()
+    if valid is not None:
+        ok &= np.asarray(valid, dtype=bool)
+    registered = pd.Series(is_registered).map(_to_registered_flag).to_numpy(dtype=bool)
+    payouts = fixed_point_payout(
+        np.where(ok, amounts_num.fillna(0).to_numpy(), 0).astype(np.int64),
+        np.broadcast_to(np.asarray(rate_bp, dtype=np.int64), ok.shape),
+        registered,
+        rounding,
+    )
+    result = pd.array(payouts, dtype='Int64')
+    result[~ok] = pd.NA
+    return result
+
+
+def room_sales_payouts(df):
+    """ルーム売上行 (個別ランク・MKランク付与済み) の支払額を一括計算する (MKsoul行・判定不能な行は <NA>)"""
+    rates, valid = room_sales_rate_bp(df['個別ランク'], df['MKランク'])
+    valid &= (df['ルームID'] != 'MKsoul').to_numpy()
+    return vectorized_payouts(df['分配額'], rates, df['is_invoice_registered'], valid)
+
+
+def other_sales_payouts(df):
+    """プレミアムライブ・タイムチャージ行の支払額を一括計算する (それ以外の行は <NA>)"""
+    rates = np.select(
+        [df['データ種別'] == 'プレミアムライブ売上', df['データ種別'] == 'タイムチャージ売上'],
+        [PAID_LIVE_RATE_BP, TIME_CHARGE_RATE_BP],
+        -1
+    )
+    valid = rates >= 0
+    return vectorized_payouts(df['分配額'], np.where(valid, rates, 0), df['is_invoice_registered'], valid)
+
+
 # --- ユーティリティ関数（ランク判定ロジック） ---
 
 def get_individual_rank(sales_amount):
@@ -255,24 +846,58 @@ def get_mk_rank(revenue):
         return 11
         
         
-def load_target_livers(url):
-    """処理対象ライバーファイルを読み込み、DataFrameとして返し、インボイスフラグを追加する"""
-    st.info(f"処理対象ライバーファイルを読み込み中... URL: {url}")
+def _st_notify(level, message):
+    """処理中のメッセージを Streamlit に表示する (level: info / success / warning / error)"""
+    getattr(st, level)(message)
+
+
+def _log_notify(level, message):
+    """処理中のメッセージをログにのみ出力する (画面に表示する先がないスレッド用)"""
+    logging.log(logging.ERROR if level == 'error' else logging.WARNING if level == 'warning' else logging.INFO, message)
+
+
+def load_target_livers(url, notify=None):
+    """
+    処理対象ライバーファイルを読み込み、DataFrameとして返し、インボイスフラグを追加する
+    同じURLの読み込みはプロセス全体 (全セッション・全アカウント) で1回にまとめ、結果を共有する
+    notify: メッセージ出力先 (level, message) を受け取る関数。省略時は Streamlit に表示する
+    """
+    if notify is None:
+        notify = _st_notify
+    df_livers, shared = get_shared_fetch_cache().get_or_compute(
+        ("roster", url),
+        # 読み込みに失敗した場合 (空のDataFrame) は共有キャッシュに残さない
+        lambda: _none_if_empty(_load_target_livers_uncached(url, notify))
+    )
+    if df_livers is None:
+        return pd.DataFrame()
+    if shared:
+        notify('info', f"♻️ 処理対象ライバーデータ ({len(df_livers)}件): 共有キャッシュの読み込み結果を使用しました。")
+    return df_livers.copy()
+
+
+def _none_if_empty(df):
+    return None if df is None or df.empty else df
+
+
+def _load_target_livers_uncached(url, notify=_st_notify):
+    """処理対象ライバーファイルを実際に読み込む (共有キャッシュを経由しない)"""
+    notify('info', f"処理対象ライバーファイルを読み込み中... URL: {url}")
     
     # 既存の読み込みロジック (省略せず保持)
     try:
         df_livers = pd.read_csv(url, encoding='utf_8_sig')
-        st.success(f"処理対象ライバーデータ ({len(df_livers)}件) の読み込みが完了しました。(エンコーディング: UTF-8 BOM)")
+        notify('success', f"処理対象ライバーデータ ({len(df_livers)}件) の読み込みが完了しました。(エンコーディング: UTF-8 BOM)")
     except Exception as e_utf8:
         try:
             df_livers = pd.read_csv(url, encoding='utf-8')
-            st.success(f"処理対象ライバーデータ ({len(df_livers)}件) の読み込みが完了しました。(エンコーディング: UTF-8)")
+            notify('success', f"処理対象ライバーデータ ({len(df_livers)}件) の読み込みが完了しました。(エンコーディング: UTF-8)")
         except Exception as e_shiftjis:
             try:
                 df_livers = pd.read_csv(url, encoding='shift_jis')
-                st.success(f"処理対象ライバーデータ ({len(df_livers)}件) の読み込みが完了しました。(エンコーディング: Shift-JIS)")
+                notify('success', f"処理対象ライバーデータ ({len(df_livers)}件) の読み込みが完了しました。(エンコーディング: Shift-JIS)")
             except Exception as e_final:
-                st.error(f"🚨 処理対象ライバーファイルの読み込みに失敗しました。エンコーディングエラー: {e_final}")
+                notify('error', f"🚨 処理対象ライバーファイルの読み込みに失敗しました。エンコーディングエラー: {e_final}")
                 return pd.DataFrame()
 
     # 読み込み成功後の共通処理
@@ -284,7 +909,7 @@ def load_target_livers(url):
     if 'ルームID' in df_livers.columns:
         df_livers['ルームID'] = df_livers['ルームID'].astype(str)
     else:
-        st.error("🚨 処理対象ライバーファイルに必須の列 **'ルームID'** が見つかりません。")
+        notify('error', "🚨 処理対象ライバーファイルに必須の列 **'ルームID'** が見つかりません。")
         return pd.DataFrame()
     
     # ★★★ 決定的な修正: インボイス登録判定ロジックのバグフィックス ★★★
@@ -305,53 +930,123 @@ def load_target_livers(url):
 
     else:
         # インボイス列がない場合は全てFalseとする
-        st.warning("⚠️ 処理対象ライバーファイルに **'インボイス'** 列が見つかりません。全てのライバーを非登録者として処理します。")
+        notify('warning', "⚠️ 処理対象ライバーファイルに **'インボイス'** 列が見つかりません。全てのライバーを非登録者として処理します。")
         df_livers['is_invoice_registered'] = False
     
-    st.info(f"インボイス登録者 ({df_livers['is_invoice_registered'].sum()}名) のフラグ付けが完了しました。")
+    notify('info', f"インボイス登録者 ({df_livers['is_invoice_registered'].sum()}名) のフラグ付けが完了しました。")
     
     return df_livers
 
 
-def get_target_months():
-    """2023年10月以降の月リストを 'YYYY年MM月分' 形式で生成し、正確なUNIXタイムスタンプを計算する"""
-    START_YEAR = 2023
-    START_MONTH = 10
-    
-    today = datetime.now(JST)
-    months = []
-    
-    current_year = today.year
-    current_month = today.month
-    
-    while True:
-        if current_year < START_YEAR or (current_year == START_YEAR and current_month < START_MONTH):
-            break 
+# 処理対象ライバーファイルでライバーの所属アカウントを指定する列 (任意)
+ROSTER_ACCOUNT_COLUMN = 'オーガナイザー'
 
-        month_str = f"{current_year}年{current_month:02d}月分"
-        
+
+def filter_livers_for_account(df_livers, account_name):
+    """
+    処理対象ライバーをアカウントの担当分に絞り込む
+    account_name が None (単一アカウントの設定) の場合は、全ライバーを対象とする
+    複数アカウントの設定でライバーファイルに所属アカウント列がない場合は、担当を判定できないため RuntimeError を送出する
+    """
+    if account_name is None or df_livers.empty:
+        return df_livers
+    if ROSTER_ACCOUNT_COLUMN not in df_livers.columns:
+        raise RuntimeError(
+            f"複数のオーガナイザーアカウントが設定されていますが、処理対象ライバーファイルに担当アカウントを示す列 '{ROSTER_ACCOUNT_COLUMN}' がありません。"
+            f"列を追加してから再実行してください。"
+        )
+    owner = df_livers[ROSTER_ACCOUNT_COLUMN].fillna('').astype(str).str.strip()
+    return df_livers[owner == account_name].reset_index(drop=True)
+
+
+# --- 月境界テーブル (プロセス内で一度だけ計算してメモ化) ---
+# 対象月の起点 (2023年10月分)
+MONTH_TABLE_START_YEAR = 2023
+MONTH_TABLE_START_MONTH = 10
+
+# (ラベル, YYYYMM, UNIXタイムスタンプ(from), 支払月 'YYYY/MM', 配信月 'YYYY/MM')
+MonthInfo = namedtuple('MonthInfo', ['label', 'ym', 'timestamp', 'pay_month', 'month_slash'])
+
+
+@functools.lru_cache(maxsize=None)
+def get_month_info(year, month):
+    """
+    指定年月の MonthInfo を返す (JSTのタイムスタンプ計算はメモ化され、同一月で再計算しない)
+    支払月は「配信月 + 2ヶ月」ルールで算出する
+    """
+    year = int(year); month = int(month)
+    dt_obj_jst = JST.localize(datetime(year, month, 1, 0, 0, 0), is_dst=None)
+    pay_year, pay_month = divmod((year * 12 + month - 1) + 2, 12)
+    return MonthInfo(
+        label=f"{year}年{month:02d}月分",
+        ym=f"{year}{month:02d}",
+        timestamp=int(dt_obj_jst.timestamp()),
+        pay_month=f"{pay_year}/{pay_month + 1:02d}",
+        month_slash=f"{year}/{month:02d}",
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_month_table(end_year, end_month):
+    """起点月から指定年月までの MonthInfo を 最新 → 古い 順のタプルで返す"""
+    table = []
+    current_year, current_month = end_year, end_month
+    while (current_year, current_month) >= (MONTH_TABLE_START_YEAR, MONTH_TABLE_START_MONTH):
         try:
-            dt_naive = datetime(current_year, current_month, 1, 0, 0, 0)
-            dt_obj_jst = JST.localize(dt_naive, is_dst=None)
-            timestamp = int(dt_obj_jst.timestamp())
-            ym_str = f"{current_year}{current_month:02d}"
-            
-            months.append((month_str, timestamp, ym_str)) # (ラベル, UNIXタイムスタンプ, YYYYMM)
+            table.append(get_month_info(current_year, current_month))
         except Exception as e:
-            logging.error(f"日付計算エラー ({month_str}): {e}")
-            
+            logging.error(f"日付計算エラー ({current_year}年{current_month:02d}月分): {e}")
+
         # 次の月（前の月）へ移動
         if current_month == 1:
             current_month = 12
             current_year -= 1
         else:
             current_month -= 1
-            
-    return months
+    return tuple(table)
+
+
+def get_month_info_by_label(label):
+    """'YYYY年MM月分' 形式のラベルから MonthInfo を返す (形式が違う・存在しない月なら None)"""
+    m = re.fullmatch(r'(\d{4})年(\d{1,2})月分', str(label).strip())
+    if not m:
+        return None
+    try:
+        return get_month_info(int(m.group(1)), int(m.group(2)))
+    except ValueError:
+        # 13月分など、存在しない月
+        return None
+
+
+def get_month_info_by_slash(month_str):
+    """'YYYY/MM' 形式 (履歴Excelの配信月) から MonthInfo を返す (解析できなければ None)"""
+    try:
+        y_s, m_s = str(month_str).split('/')
+        return get_month_info(int(y_s), int(m_s))
+    except Exception:
+        return None
+
 
+def get_month_info_by_timestamp(timestamp):
+    """取得に使ったUNIXタイムスタンプ (JSTの月初) から MonthInfo を返す"""
+    dt = datetime.fromtimestamp(int(timestamp), JST)
+    return get_month_info(dt.year, dt.month)
 
-def create_authenticated_session(cookie_string):
-    """手動で取得したCookie文字列から認証済みRequestsセッションを構築する"""
+
+def get_target_months():
+    """2023年10月以降の月リストを 'YYYY年MM月分' 形式で生成し、正確なUNIXタイムスタンプを計算する"""
+    today = datetime.now(JST)
+    # (ラベル, UNIXタイムスタンプ, YYYYMM)
+    return [(info.label, info.timestamp, info.ym) for info in get_month_table(today.year, today.month)]
+
+
+def create_authenticated_session(cookie_string, notify=None):
+    """
+    手動で取得したCookie文字列から認証済みRequestsセッションを構築する
+    notify: メッセージ出力先 (level, message) を受け取る関数。省略時は Streamlit に表示する
+    """
+    if notify is None:
+        notify = _st_notify
     session = requests.Session()
     try:
         cookies_dict = {}
@@ -364,232 +1059,2146 @@ def create_authenticated_session(cookie_string):
         session.cookies.update(cookies_dict)
         
         if not cookies_dict:
-            st.error("🚨 有効な認証セッションを解析できませんでした。")
+            notify('error', "🚨 有効な認証セッションを解析できませんでした。")
             return None
             
         return session
     except Exception as e:
-        st.error(f"認証セッションを解析中にエラーが発生しました: {e}")
+        notify('error', f"認証セッションを解析中にエラーが発生しました: {e}")
         return None
 
 
-def fetch_and_process_data(timestamp, cookie_string, sr_url, data_type_key):
+def fetch_and_process_data(timestamp, cookie_string, sr_url, data_type_key, login_id=None, deadline=None, notify=None):
     """
     指定されたタイムスタンプに基づいてSHOWROOMからデータを取得し、DataFrameに整形して返す
+    同じ (データ種別, タイムスタンプ, アカウント) の取得はプロセス全体で1回にまとめ、結果を共有する
+    login_id: MKsoul 合計行に付けるログインID (省略時は既定のアカウント)
+    deadline: 実行全体の期限 (RunDeadline)。過ぎている場合は取得せず None を返す
+    再試行しても回復しない失敗 (401/403/429 以外の 4xx) は PermanentFetchError を送出する
+    notify: メッセージ出力先 (level, message) を受け取る関数。省略時は Streamlit に表示する
     """
-    st.info(f"データ取得中... **{DATA_TYPES[data_type_key]['label']}** (URL: {sr_url}, タイムスタンプ: {timestamp})")
-    session = create_authenticated_session(cookie_string)
-    if not session:
+    if notify is None:
+        notify = _st_notify
+    if login_id is None:
+        login_id = LOGIN_ID
+    # 認証切れを検出済みのアカウントは、以降の取得を全て即座に中止する (サーキットブレーカー)
+    breaker = get_auth_breaker(cookie_string)
+    if breaker.is_open():
+        logging.info(f"認証切れのため取得をスキップしました: {DATA_TYPES[data_type_key]['label']} ({timestamp})")
         return None
-    
+    if deadline is not None and deadline.expired():
+        deadline.hit = True
+        logging.info(f"実行全体の期限を過ぎたため取得をスキップしました: {DATA_TYPES[data_type_key]['label']} ({timestamp})")
+        return None
+
+    cache_key = ("showroom", data_type_key, sr_url, int(timestamp), cookie_fingerprint(cookie_string), login_id)
     try:
-        # 1. データ取得
-        url = f"{sr_url}?from={timestamp}" 
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0.4896.127 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
-            'Accept-Language': 'ja,en-US;q=0.9,en;q=0.8',
-            'Referer': sr_url
-        }
-        
-        response = session.get(url, headers=headers, timeout=30)
-        response.raise_for_status() 
-        
-        # 2. HTMLからのデータ抽出
-        soup = BeautifulSoup(response.text, 'html5lib') 
-        table = soup.find('table', class_='table-type-02') 
-        
-        if not table:
-            if "ログイン" in response.text or "会員登録" in response.text:
-                st.error("🚨 認証切れです。Cookieが古いか無効になっています。")
-                return None
-            st.warning(f"**{DATA_TYPES[data_type_key]['label']}**: HTMLから売上データテーブルを検出できませんでした。データがまだ生成されていないか、ページ構造が変更されました。")
-            return pd.DataFrame(columns=['ルームID', '分配額', 'アカウントID', 'データ種別']) 
-            
-        # 3. データをBeautifulSoupで抽出 (ライバー個別のデータ)
-        table_data = []
-        rows = table.find_all('tr')
-        
-        for row in rows[1:]: 
-            td_tags = row.find_all('td')
-            
-            if len(td_tags) >= 5:
-                room_id_str = td_tags[0].text.strip() 
-                amount_str = td_tags[3].text.strip().replace(',', '') 
-                account_id = td_tags[4].text.strip()
-                
-                if amount_str.isnumeric():
-                    table_data.append({
-                        'ルームID': room_id_str, 
-                        '分配額': int(amount_str), 
-                        'アカウントID': account_id
-                    })
-        
-        # 4. DataFrameに変換
-        df_cleaned = pd.DataFrame(table_data)
-        
-        # --- ルーム売上 (room_sales) の特殊処理: MKsoulの合計行を追加 ---
-        if data_type_key == "room_sales":
-            
-            # 修正: class属性と正規表現をご提示のパターンに合わせる
-            total_amount_tag = soup.find('p', class_='fs-b4 bg-light-gray p-b3 mb-b2 link-light-green')
-            total_amount_int = 0
-            
-            if total_amount_tag:
-                # <span>タグ内を検索して、支払い金額（税抜）を抽出
-                match = re.search(r'支払い金額（税抜）:\s*<span[^>]*>\s*([\d,]+)円', str(total_amount_tag))
-                
-                if match:
-                    total_amount_str = match.group(1).replace(',', '') 
-                    if total_amount_str.isnumeric():
-                        total_amount_int = int(total_amount_str)
-                        st.info(f"✅ スクレイピングによるMK全体分配額の取得に成功しました: **{total_amount_int:,}円**")
-                    else:
-                        st.error("🚨 抽出した文字列が数値に変換できませんでした。")
+        df, shared = get_shared_fetch_cache().get_or_compute(
+            cache_key,
+            lambda: _fetch_and_process_data_uncached(timestamp, cookie_string, sr_url, data_type_key, login_id, deadline, notify)
+        )
+    except AuthExpiredError as e:
+        breaker.trip(str(e))
+        notify('error', "🚨 認証切れです。Cookieが古いか無効になっています。残りの取得は全て中止します。")
+        return None
+    except PermanentFetchError as e:
+        notify('error', f"🚨 **{DATA_TYPES[data_type_key]['label']}** ({timestamp}): 取得できませんでした ({e})。再試行しても回復しないため、再開時はスキップします。")
+        raise
+    if df is None:
+        if shared:
+            notify('error', f"🚨 **{DATA_TYPES[data_type_key]['label']}** ({timestamp}): 同時に実行された取得が失敗しました。")
+        return None
+    if shared:
+        notify('info', f"♻️ **{DATA_TYPES[data_type_key]['label']}** ({timestamp}): 共有キャッシュの取得結果を使用しました。")
+    # セッション間で共有するため、呼び出し側には複製を返す
+    return df.copy()
+
+
+def parse_sales_html(html_text, data_type_key, timestamp, login_id, notify=None):
+    """
+    SHOWROOMの請求書ページHTMLから売上データを抽出し、DataFrameに整形して返す
+    認証切れ (ログインページ) の場合は None を返す
+    notify: メッセージ出力先 (level, message) を受け取る関数。省略時は Streamlit に表示する
+    """
+    if notify is None:
+        notify = _st_notify
+
+    # 2. HTMLからのデータ抽出
+    soup = BeautifulSoup(html_text, 'html5lib') 
+    table = soup.find('table', class_='table-type-02') 
+    is_login_page = (not table) and ("ログイン" in html_text or "会員登録" in html_text)
+    # 生HTMLは以降不要なため解放する
+    del html_text
+    log_memory_usage(f"{DATA_TYPES[data_type_key]['label']} ({timestamp}) HTML解析後")
+
+    if not table:
+        soup.decompose()
+        if is_login_page:
+            notify('error', "🚨 認証切れです。Cookieが古いか無効になっています。")
+            return None
+        notify('warning', f"**{DATA_TYPES[data_type_key]['label']}**: HTMLから売上データテーブルを検出できませんでした。データがまだ生成されていないか、ページ構造が変更されました。")
+        return pd.DataFrame(columns=['ルームID', '分配額', 'アカウントID', 'データ種別']) 
+
+    # 3. データをBeautifulSoupで抽出 (ライバー個別のデータ)
+    table_data = []
+    rows = table.find_all('tr')
+
+    for row in rows[1:]: 
+        td_tags = row.find_all('td')
+
+        if len(td_tags) >= 5:
+            room_id_str = td_tags[0].text.strip() 
+            amount_str = td_tags[3].text.strip().replace(',', '') 
+            account_id = td_tags[4].text.strip()
+
+            if amount_str.isnumeric():
+                table_data.append({
+                    'ルームID': room_id_str, 
+                    '分配額': int(amount_str), 
+                    'アカウントID': account_id
+                })
+
+    # 合計金額タグ (ルーム売上のみ) は必要な部分だけ文字列化して保持する
+    total_amount_html = None
+    if data_type_key == "room_sales":
+        # 修正: class属性と正規表現をご提示のパターンに合わせる
+        total_amount_tag = soup.find('p', class_='fs-b4 bg-light-gray p-b3 mb-b2 link-light-green')
+        if total_amount_tag:
+            total_amount_html = str(total_amount_tag)
+
+    # 抽出が終わった時点で解析ツリーを解放する
+    del rows, table
+    soup.decompose()
+    del soup
+    log_memory_usage(f"{DATA_TYPES[data_type_key]['label']} ({timestamp}) 抽出・解放後")
+
+    # 4. DataFrameに変換
+    df_cleaned = pd.DataFrame(table_data)
+
+    # --- ルーム売上 (room_sales) の特殊処理: MKsoulの合計行を追加 ---
+    if data_type_key == "room_sales":
+
+        total_amount_int = 0
+
+        if total_amount_html:
+            # <span>タグ内を検索して、支払い金額（税抜）を抽出
+            match = re.search(r'支払い金額（税抜）:\s*<span[^>]*>\s*([\d,]+)円', total_amount_html)
+
+            if match:
+                total_amount_str = match.group(1).replace(',', '') 
+                if total_amount_str.isnumeric():
+                    total_amount_int = int(total_amount_str)
+                    notify('info', f"✅ スクレイピングによるMK全体分配額の取得に成功しました: **{total_amount_int:,}円**")
                 else:
-                    st.error("🚨 HTMLの指定タグ内で「支払い金額（税抜）：[金額]円」のパターンが見つかりませんでした。")
+                    notify('error', "🚨 抽出した文字列が数値に変換できませんでした。")
             else:
-                st.error("🚨 合計金額を示すタグ (`p` class='fs-b4...') がHTML内に見つかりませんでした。")
+                notify('error', "🚨 HTMLの指定タグ内で「支払い金額（税抜）：[金額]円」のパターンが見つかりませんでした。")
+        else:
+            notify('error', "🚨 合計金額を示すタグ (`p` class='fs-b4...') がHTML内に見つかりませんでした。")
 
 
-            header_data = [{
-                'ルームID': 'MKsoul', # ルームIDは固定値
-                '分配額': total_amount_int,
-                'アカウントID': LOGIN_ID # secretsから取得したログインID
-            }]
-            header_df = pd.DataFrame(header_data)
-            
-            if not df_cleaned.empty:
-                df_final = pd.concat([header_df, df_cleaned], ignore_index=True)
-                st.success(f"**{DATA_TYPES[data_type_key]['label']}**: ライバー個別データ ({len(df_cleaned)}件) と合計値 ({total_amount_int:,}円) の抽出が完了しました。")
-            else:
-                df_final = header_df
-                st.warning(f"**{DATA_TYPES[data_type_key]['label']}**: ライバー個別のデータ行を抽出できませんでした。合計値 ({total_amount_int:,}円) のみを含む1行データとして処理を続行します。")
+        header_data = [{
+            'ルームID': 'MKsoul', # ルームIDは固定値
+            '分配額': total_amount_int,
+            'アカウントID': login_id # secretsから取得したログインID
+        }]
+        header_df = pd.DataFrame(header_data)
 
-        else: # time_charge or premium_live
-            if df_cleaned.empty:
-                st.warning(f"**{DATA_TYPES[data_type_key]['label']}**: 有効なデータ行を抽出できませんでした。")
-                df_final = pd.DataFrame(columns=['ルームID', '分配額', 'アカウントID']) 
-            else:
-                df_final = df_cleaned
-                st.success(f"**{DATA_TYPES[data_type_key]['label']}**: データ ({len(df_final)}件) の抽出が完了しました。")
+        if not df_cleaned.empty:
+            df_final = pd.concat([header_df, df_cleaned], ignore_index=True)
+            notify('success', f"**{DATA_TYPES[data_type_key]['label']}**: ライバー個別データ ({len(df_cleaned)}件) と合計値 ({total_amount_int:,}円) の抽出が完了しました。")
+        else:
+            df_final = header_df
+            notify('warning', f"**{DATA_TYPES[data_type_key]['label']}**: ライバー個別のデータ行を抽出できませんでした。合計値 ({total_amount_int:,}円) のみを含む1行データとして処理を続行します。")
 
-        # 5. データ種別列を追加
-        df_final['データ種別'] = DATA_TYPES[data_type_key]['label']
-        
-        # ルームIDを結合キーとして文字列に統一
-        df_final['ルームID'] = df_final['ルームID'].astype(str)
+    else: # time_charge or premium_live
+        if df_cleaned.empty:
+            notify('warning', f"**{DATA_TYPES[data_type_key]['label']}**: 有効なデータ行を抽出できませんでした。")
+            df_final = pd.DataFrame(columns=['ルームID', '分配額', 'アカウントID']) 
+        else:
+            df_final = df_cleaned
+            notify('success', f"**{DATA_TYPES[data_type_key]['label']}**: データ ({len(df_final)}件) の抽出が完了しました。")
+
+    # 5. データ種別列を追加
+    df_final['データ種別'] = DATA_TYPES[data_type_key]['label']
+
+    # ルームIDを結合キーとして文字列に統一
+    df_final['ルームID'] = df_final['ルームID'].astype(str)
+
+    return df_final
+
+
+def _fetch_and_process_data_uncached(timestamp, cookie_string, sr_url, data_type_key, login_id, deadline=None, notify=_st_notify):
+    """SHOWROOMから実際にデータを取得・整形する (共有キャッシュを経由しない)"""
+    notify('info', f"データ取得中... **{DATA_TYPES[data_type_key]['label']}** (URL: {sr_url}, タイムスタンプ: {timestamp})")
+    session = create_authenticated_session(cookie_string, notify)
+    if not session:
+        return None
+    
+    try:
+        # 1. データ取得
+        url = f"{sr_url}?from={timestamp}" 
+        headers = dict(SR_REQUEST_HEADERS, Referer=sr_url)
+
+        def attempt(timeout, cancel):
+            # ストリーミングで上限付きバッファへ取得し、本文はバイト列として返してバッファはすぐに解放する
+            # (バッファはスレッドごとのため、ヘッジで並行する試行どうしでは共有されない。セッションの接続プールはスレッド間で共有できる)
+            buf, encoding = download_to_buffer(session, url, MAX_HTML_BYTES, cancel=cancel, headers=headers, timeout=timeout)
+            try:
+                return buf.getvalue(), encoding
+            finally:
+                release_download_buffer()
+
+        raw_bytes, encoding = call_with_policy(SHOWROOM_FETCH_POLICY, attempt, deadline, label=DATA_TYPES[data_type_key]['label'])
+        log_memory_usage(f"{DATA_TYPES[data_type_key]['label']} ({timestamp}) ダウンロード後")
         
+        # 生HTMLは抽出処理の中でのみ保持する (デコードは取得完了後に本文全体を一度に行う)
+        df_final = parse_sales_html(raw_bytes.decode(encoding or 'utf-8', errors='replace'), data_type_key, timestamp, login_id, notify)
+        if df_final is None:
+            # ログインページが返された = 認証切れ
+            raise AuthExpiredError(f"{DATA_TYPES[data_type_key]['label']} の取得時にログインページが返されました")
+
+        # 抽出できたページのみを圧縮してアーカイブし、オフライン再処理に使えるようにする (ログインページは保存しない)
+        archive_raw_html(url, data_type_key, timestamp, cookie_string, raw_bytes, encoding)
         return df_final
         
     except requests.exceptions.HTTPError as e:
-        st.error(f"HTTPエラーが発生しました: {e.response.status_code}. 認証Cookieが無効になっている可能性があります。")
+        if e.response is not None and e.response.status_code in (401, 403):
+            raise AuthExpiredError(f"HTTP {e.response.status_code} ({DATA_TYPES[data_type_key]['label']})") from e
+        if e.response is not None and 400 <= e.response.status_code < 500 and e.response.status_code != 429:
+            raise PermanentFetchError(f"HTTP {e.response.status_code} ({DATA_TYPES[data_type_key]['label']})") from e
+        notify('error', f"HTTPエラーが発生しました: {e.response.status_code}. 認証Cookieが無効になっている可能性があります。")
         return None
+    except ResponseTooLargeError as e:
+        notify('error', f"🚨 レスポンスサイズが上限を超えたため取得を中止しました: {e}")
+        return None
+    except FetchDeadlineExceeded as e:
+        notify('warning', f"⏱️ {DATA_TYPES[data_type_key]['label']} ({timestamp}): {e}")
+        return None
+    except (AuthExpiredError, PermanentFetchError):
+        raise
     except Exception as e:
-        st.error(f"予期せぬエラーが発生しました: {e}")
+        notify('error', f"予期せぬエラーが発生しました: {e}")
         logging.error("データ取得・整形エラー", exc_info=True)
         return None
 
 
-def get_and_extract_sales_data(data_type_key, selected_timestamp, auth_cookie_string):
+# --- 生HTMLアーカイブ (オフライン再処理用) ---
+# 取得した請求書ページを gzip 圧縮で保存するディレクトリとインデックス
+HTML_ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".html_archive")
+HTML_ARCHIVE_INDEX = os.path.join(HTML_ARCHIVE_DIR, "index.jsonl")
+# (データ種別, タイムスタンプ, アカウント) ごとに保持する取得分の件数
+HTML_ARCHIVE_LIMIT = 3
+# 処理対象ライバーファイルの最新スナップショット (オフライン再処理で使用)
+TARGET_LIVERS_SNAPSHOT = os.path.join(HTML_ARCHIVE_DIR, "target_livers.pkl.gz")
+
+_archive_lock = threading.Lock()
+
+
+def archive_raw_html(url, data_type_key, timestamp, cookie_string, raw_bytes, encoding):
     """
-    指定されたデータタイプの売上データを取得し、セッションステートに格納する
+    取得した生HTMLを gzip 圧縮で保存し、インデックス (URL, fromタイムスタンプ, 取得日時) に追記する
+    同じページの取得分が HTML_ARCHIVE_LIMIT 件を超えたら古いものを削除する
+    アーカイブの失敗は取得処理を止めない
     """
-    data_label = DATA_TYPES[data_type_key]["label"]
-    sr_url = DATA_TYPES[data_type_key]["url"]
-    
-    # 1. データ取得と整形
-    df_sales = fetch_and_process_data(selected_timestamp, auth_cookie_string, sr_url, data_type_key)
-    
-    if df_sales is not None:
-        # セッションステートに格納
-        st.session_state[f'df_{data_type_key}'] = df_sales
-    else:
-        st.session_state[f'df_{data_type_key}'] = pd.DataFrame(columns=['ルームID', '分配額', 'アカウントID', 'データ種別'])
-    
-    st.markdown("---")
+    try:
+        fetched_at = datetime.now(JST)
+        file_name = f"{data_type_key}_{timestamp}_{fetched_at.strftime('%Y%m%d%H%M%S%f')}.html.gz"
+        os.makedirs(HTML_ARCHIVE_DIR, exist_ok=True)
+        with gzip.open(os.path.join(HTML_ARCHIVE_DIR, file_name), 'wb') as f:
+            f.write(raw_bytes)
+        entry = {
+            'url': url,
+            'data_type_key': data_type_key,
+            'timestamp': int(timestamp),
+            'fetched_at': fetched_at.isoformat(),
+            'account': cookie_fingerprint(cookie_string),
+            'encoding': encoding,
+            'file': file_name,
+            'bytes': len(raw_bytes),
+        }
+        with _archive_lock:
+            with open(HTML_ARCHIVE_INDEX, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            _prune_archive(entry)
+    except Exception as e:
+        logging.warning(f"生HTMLのアーカイブに失敗しました ({url}): {e}")
+
+
+def _archive_key(entry):
+    return (entry['data_type_key'], entry['timestamp'], entry.get('account'))
+
+
+def _prune_archive(new_entry):
+    """
+    new_entry と同じページの取得分を新しい HTML_ARCHIVE_LIMIT 件だけ残し、古いアーカイブとインデックス行を削除する
+    (_archive_lock を保持して呼ぶ)
+    """
+    entries = _read_archive_index()
+    same_page = sorted((e for e in entries if _archive_key(e) == _archive_key(new_entry)), key=lambda e: e['fetched_at'])
+    stale_files = {e['file'] for e in same_page[:-HTML_ARCHIVE_LIMIT]}
+    if not stale_files:
+        return
+    # インデックスは一時ファイルに書き出してから置き換え、読み込み側に書きかけの状態を見せない
+    tmp_path = HTML_ARCHIVE_INDEX + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for e in entries:
+            if e['file'] not in stale_files:
+                f.write(json.dumps(e, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, HTML_ARCHIVE_INDEX)
+    for file_name in stale_files:
+        try:
+            os.remove(os.path.join(HTML_ARCHIVE_DIR, file_name))
+        except FileNotFoundError:
+            pass
+
+
+def _read_archive_index():
+    """インデックスの全行を読み込む (解析できない行は読み飛ばす)"""
+    entries = []
+    try:
+        with open(HTML_ARCHIVE_INDEX, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    logging.warning(f"アーカイブのインデックス行を解析できませんでした: {line[:80]}")
+    except FileNotFoundError:
+        return []
+    return entries
+
+
+def list_archived_pages(account=None, latest_only=True):
+    """
+    アーカイブ済みページのインデックスを返す
+    latest_only: (データ種別, タイムスタンプ, アカウント) ごとに最新の取得分のみを返す
+    """
+    entries = _read_archive_index()
+    if account is not None:
+        entries = [e for e in entries if e.get('account') == account]
+    if latest_only:
+        latest = {}
+        for e in entries:
+            k = _archive_key(e)
+            if k not in latest or e['fetched_at'] > latest[k]['fetched_at']:
+                latest[k] = e
+        entries = list(latest.values())
+    return sorted(entries, key=lambda e: (e['timestamp'], e['data_type_key'], e['fetched_at']), reverse=True)
+
+
+def load_archived_html(entry):
+    """アーカイブ1件を展開してHTML文字列として返す"""
+    with gzip.open(os.path.join(HTML_ARCHIVE_DIR, entry['file']), 'rb') as f:
+        return f.read().decode(entry.get('encoding') or 'utf-8', errors='replace')
+
+
+def _reprocess_archived_page(entry, login_id):
+    """アーカイブ1件から売上データを再抽出する (ワーカーで実行するため Streamlit には出力しない)"""
+    messages = []
+    df = parse_sales_html(
+        load_archived_html(entry), entry['data_type_key'], entry['timestamp'], login_id,
+        notify=lambda level, message: messages.append((level, message))
+    )
+    return entry, df, messages
+
+
+def reprocess_archive(entries, login_id, max_workers=None):
+    """
+    アーカイブ済みページを通信なしで並列 (スレッド) に再抽出する
+    戻り値: ({(データ種別, タイムスタンプ): DataFrame または None}, [(level, message), ...])
+    """
+    results = {}
+    messages = []
+    if not entries:
+        return results, messages
+
+    # Streamlit のスクリプトはプロセスの fork と相性が悪いため、ワーカーはスレッドで実行する
+    # (対象は選択月と繰越月のページのみのため、件数は少ない)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="archive-reprocess") as executor:
+        futures = {executor.submit(_reprocess_archived_page, e, login_id): e for e in entries}
+        for future in as_completed(futures):
+            entry = futures[future]
+            try:
+                _, df, page_messages = future.result()
+            except Exception as e:
+                df, page_messages = None, [('error', f"アーカイブの再抽出に失敗しました ({entry['file']}): {e}")]
+            results[(entry['data_type_key'], entry['timestamp'])] = df
+            messages.extend(page_messages)
+
+    return results, messages
+
+
+def save_target_livers_snapshot(df_livers):
+    """処理対象ライバーファイルの読み込み結果をオフライン再処理用に保存する"""
+    try:
+        os.makedirs(HTML_ARCHIVE_DIR, exist_ok=True)
+        df_livers.to_pickle(TARGET_LIVERS_SNAPSHOT, compression='gzip')
+    except Exception as e:
+        logging.warning(f"処理対象ライバーファイルのスナップショット保存に失敗しました: {e}")
+
+
+def load_target_livers_snapshot():
+    """保存済みの処理対象ライバーファイルを読み込む (なければ空のDataFrame)"""
+    try:
+        return pd.read_pickle(TARGET_LIVERS_SNAPSHOT, compression='gzip')
+    except Exception:
+        return pd.DataFrame()
+
+
+# --- 実行チェックポイント (途中失敗からの再開用) ---
+# 配信月ごとの実行状態を保存するディレクトリ
+CHECKPOINT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".run_checkpoints")
+
+
+class RunCheckpoint:
+    """
+    1回の実行 (配信月単位) の進捗をローカルに保存し、再実行時に完了済みステップを再利用する
+    - fetches: (データ種別, タイムスタンプ) ごとの取得結果 (DataFrameはpickleで保存)
+    - livers: ライバー (ファイル名) ごとの繰越月解決結果
+    - failures: 失敗したステップと理由 (成功すると解除される)
+                再試行しても回復しない失敗は terminal として記録し、再開時に再取得せず、実行の完了も妨げない
+    同じ実行のチェックポイントは get_run_checkpoint() でプロセス内の1つのインスタンスを共有する
+    """
+
+    def __init__(self, run_key):
+        self.run_key = str(run_key)
+        self.run_dir = os.path.join(CHECKPOINT_DIR, self.run_key)
+        self.state_path = os.path.join(self.run_dir, "state.json")
+        self._lock = threading.RLock()
+        os.makedirs(self.run_dir, exist_ok=True)
+        self.state = self._load()
+
+    def _load(self):
+        empty = {"completed": False, "fetches": {}, "livers": {}, "failures": {}}
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                state = json.load(f)
+            for k, v in empty.items():
+                state.setdefault(k, v)
+            return state
+        except FileNotFoundError:
+            return empty
+        except Exception as e:
+            logging.warning(f"チェックポイントの読み込みに失敗したため新規に作成します ({self.state_path}): {e}")
+            return empty
+
+    def _save(self):
+        # 書き込み途中で中断しても壊れないよう、一時ファイル経由で置き換える
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.state_path)
+
+    @staticmethod
+    def fetch_step(data_type_key, timestamp):
+        return f"fetch:{data_type_key}:{timestamp}"
+
+    @staticmethod
+    def liver_step(file_basename):
+        return f"liver:{file_basename}"
+
+    def has_progress(self):
+        with self._lock:
+            return bool(self.state["fetches"] or self.state["livers"] or self.state["failures"])
+
+    def is_completed(self):
+        with self._lock:
+            return bool(self.state.get("completed"))
+
+    def get_fetch(self, data_type_key, timestamp):
+        """保存済みの取得結果を返す (未取得なら None)"""
+        with self._lock:
+            file_name = self.state["fetches"].get(self.fetch_step(data_type_key, timestamp))
+        if not file_name:
+            return None
+        try:
+            return pd.read_pickle(os.path.join(self.run_dir, file_name))
+        except Exception as e:
+            logging.warning(f"チェックポイントの取得結果を読み込めませんでした ({file_name}): {e}")
+            return None
+
+    def save_fetch(self, data_type_key, timestamp, df):
+        step = self.fetch_step(data_type_key, timestamp)
+        file_name = f"{data_type_key}_{timestamp}.pkl"
+        df.to_pickle(os.path.join(self.run_dir, file_name))
+        with self._lock:
+            self.state["fetches"][step] = file_name
+            self.state["failures"].pop(step, None)
+            self._save()
+
+    def fetched_frames(self):
+        """保存済みの取得結果を (データ種別, タイムスタンプ, DataFrame) のリストで返す"""
+        with self._lock:
+            steps = list(self.state["fetches"])
+        frames = []
+        for step in steps:
+            _, data_type_key, timestamp = step.split(':')
+            df = self.get_fetch(data_type_key, timestamp)
+            if df is not None:
+                frames.append((data_type_key, int(timestamp), df))
+        return frames
+
+    def get_liver(self, file_basename):
+        """保存済みのライバー繰越解決結果 (配信月リスト) を返す (未解決なら None)"""
+        with self._lock:
+            return self.state["livers"].get(str(file_basename))
+
+    def livers(self):
+        """解決済みのライバー繰越結果 (ファイル名 -> 配信月リスト) の複製を返す"""
+        with self._lock:
+            return {k: list(v) for k, v in self.state["livers"].items()}
+
+    def save_liver(self, file_basename, months_list):
+        with self._lock:
+            self.state["livers"][str(file_basename)] = list(months_list)
+            self.state["failures"].pop(self.liver_step(file_basename), None)
+            self._save()
+
+    def record_failure(self, step, reason, terminal=False):
+        """
+        失敗したステップを記録する
+        terminal=True: 再試行しても回復しない失敗 (再開時は再取得せず、実行の完了も妨げない)
+        """
+        with self._lock:
+            self.state["failures"][step] = {
+                "reason": str(reason),
+                "at": datetime.now(JST).strftime('%Y-%m-%d %H:%M:%S'),
+                "terminal": bool(terminal),
+            }
+            if not terminal:
+                self.state["completed"] = False
+            self._save()
+
+    def is_terminal_failure(self, step):
+        with self._lock:
+            return bool(self.state["failures"].get(step, {}).get("terminal"))
+
+    def has_retryable_failures(self):
+        """再実行で回復し得る失敗が残っているか"""
+        with self._lock:
+            return any(not info.get("terminal") for info in self.state["failures"].values())
+
+    def clear_failure(self, step):
+        with self._lock:
+            if self.state["failures"].pop(step, None) is not None:
+                self._save()
+
+    def failures(self):
+        with self._lock:
+            return dict(self.state["failures"])
+
+    def mark_completed(self):
+        with self._lock:
+            self.state["completed"] = True
+            self._save()
+
+    def clear(self):
+        """保存済みの進捗を全て破棄する"""
+        with self._lock:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+            os.makedirs(self.run_dir, exist_ok=True)
+            self.state = {"completed": False, "fetches": {}, "livers": {}, "failures": {}}
+
+
+@st.cache_resource
+def _get_run_checkpoint_registry():
+    """全セッションで共有するチェックポイントの登録表"""
+    return {'lock': threading.Lock(), 'checkpoints': {}}
+
+
+def get_run_checkpoint(run_key):
+    """
+    実行キーに対応するチェックポイントを返す
+    バックグラウンドのジョブと画面側の再計算が同じ state.json を別々のインスタンスで上書きし合わないよう、
+    同じ実行キーにはプロセス内で1つのインスタンスを共有する
+    """
+    registry = _get_run_checkpoint_registry()
+    with registry['lock']:
+        checkpoint = registry['checkpoints'].get(str(run_key))
+        if checkpoint is None:
+            checkpoint = RunCheckpoint(run_key)
+            registry['checkpoints'][str(run_key)] = checkpoint
+        return checkpoint
+
+
+def fetch_with_checkpoint(checkpoint, timestamp, cookie_string, data_type_key, offline=False, login_id=None, deadline=None, notify=None):
+    """
+    チェックポイントに保存済みならそれを返し、なければ取得して保存する
+    取得に失敗した場合は失敗として記録し None を返す
+    offline=True の場合は通信せず、チェックポイント (アーカイブからの再抽出結果) にある分のみを返す
+    notify: 取得時のメッセージ出力先 (fetch_and_process_data に渡す)
+    """
+    step = RunCheckpoint.fetch_step(data_type_key, timestamp)
+    if checkpoint is not None:
+        df_cached = checkpoint.get_fetch(data_type_key, timestamp)
+        if df_cached is not None:
+            return df_cached
+        # 再試行しても回復しない失敗として記録済みのステップは再取得しない
+        if checkpoint.is_terminal_failure(step):
+            return None
+
+    if offline:
+        if checkpoint is not None:
+            checkpoint.record_failure(
+                step,
+                f"{DATA_TYPES[data_type_key]['label']} のアーカイブがないため、オフラインでは処理できません"
+            )
+        return None
+
+    try:
+        df = fetch_and_process_data(timestamp, cookie_string, DATA_TYPES[data_type_key]["url"], data_type_key, login_id, deadline, notify)
+    except PermanentFetchError as e:
+        if checkpoint is not None:
+            checkpoint.record_failure(step, f"{DATA_TYPES[data_type_key]['label']} を取得できませんでした ({e})", terminal=True)
+        return None
+
+    if checkpoint is not None:
+        if df is None:
+            breaker = get_auth_breaker(cookie_string)
+            if breaker.is_open():
+                reason = f"{DATA_TYPES[data_type_key]['label']} の取得を中止しました (認証切れ: {breaker.reason})"
+            elif deadline is not None and deadline.hit:
+                reason = f"{DATA_TYPES[data_type_key]['label']} の取得を打ち切りました (実行全体の期限切れ)"
+            else:
+                reason = f"{DATA_TYPES[data_type_key]['label']} の取得に失敗しました (認証切れ・通信エラーの可能性)"
+            checkpoint.record_failure(step, reason)
+        else:
+            checkpoint.save_fetch(data_type_key, timestamp, df)
+    return df
+
+
+def build_extracted_data(df_livers, all_sales_data, df_room_sales, selected_month_label, login_account_id, cookie_string, checkpoint=None, offline=False, progress=None, deadline=None, notify=None):
+    """
+    処理対象ライバーと売上データを結合し、ランク・支払額の付与と繰越月分の追加を行った最終DataFrameを返す
+    checkpoint が指定された場合、繰越月の取得・ライバーごとの繰越解決はチェックポイントを再利用する
+    offline=True の場合は通信せず、チェックポイントにある取得結果・繰越解決のみを使う
+    progress: 繰越処理の進捗 (処理済みライバー数, 全ライバー数) を受け取る関数
+    deadline: 実行全体の期限 (RunDeadline)。過ぎた時点で残りのライバーの繰越処理を打ち切る
+    notify: メッセージ出力先 (level, message) を受け取る関数。省略時は Streamlit に表示する
+    """
+    if notify is None:
+        notify = _st_notify
+    # ルームIDをキーに処理対象ライバーと結合
+    df_merged = pd.merge(
+        df_livers,
+        all_sales_data,
+        on='ルームID',
+        how='left'
+    )
+
+    # 売上データがないライバー（NULL行）の分配額を0として処理
+    df_merged['分配額'] = df_merged['分配額'].fillna(0).astype(int)
+
+    # 表示用に、売上がゼロの行のデータ種別をNaNから「売上なし」などに変換
+    df_merged['データ種別'] = df_merged['データ種別'].fillna('売上データなし')
+
+    # 配信月とアカウントIDを追加
+    df_merged['配信月'] = selected_month_label
+    # アカウントIDを埋める
+    df_merged['アカウントID'] = df_merged.apply(
+        lambda row: row['アカウントID'] if pd.notna(row['アカウントID']) else login_account_id if row['ルームID'] == 'MKsoul' else np.nan, axis=1
+    )
+
+    # ★★★ 修正点3: マージ直後にis_invoice_registered列を明示的にbool型に再キャストする (二重の防御) ★★★
+    if 'is_invoice_registered' in df_merged.columns:
+        df_merged['is_invoice_registered'] = df_merged['is_invoice_registered'].astype(bool)
+
+
+    # 🌟 ルーム売上のみにランク情報を付与 🌟
+    # df_mergedを「ルーム売上」データと「その他」データに分割
+    df_room_sales_only = df_merged[df_merged['データ種別'] == 'ルーム売上'].copy()
+    df_other_sales = df_merged[df_merged['データ種別'] != 'ルーム売上'].copy()
+
+
+    if not df_room_sales_only.empty:
+
+        # 1. MKランク（全体ランク）の決定
+        df_raw_room_sales = df_room_sales
+
+        try:
+            mk_sales_total = df_raw_room_sales[df_raw_room_sales['ルームID'] == 'MKsoul']['分配額'].iloc[0].item() 
+            if mk_sales_total == 0:
+                notify('warning', "⚠️ MK全体分配額が0です。SHOWROOM側のデータがないか、合計金額の抽出に失敗している可能性があります。")
+        except IndexError:
+            mk_sales_total = 0
+            notify('error', "🚨 重大なエラー: 合計売上を示す 'MKsoul' 行がデータ取得元から見つかりませんでした。")
+        except Exception as e:
+            mk_sales_total = 0
+            notify('error', f"🚨 重大なエラー: 合計売上計算中に予期せぬエラーが発生しました: {e}")
+
+        mk_rank_value = get_mk_rank(mk_sales_total)
+        notify('info', f"🔑 **MK全体分配額**: {mk_sales_total:,}円 (→ **MKランク: {mk_rank_value}**)")
+
+        # MKランク、個別ランクの設定
+        df_room_sales_only['MKランク'] = mk_rank_value
+        df_room_sales_only['個別ランク'] = df_room_sales_only['分配額'].apply(get_individual_rank)
+
+        # 適用料率の生成
+        df_room_sales_only['適用料率'] = np.where(
+            df_room_sales_only['ルームID'] == 'MKsoul',
+            '-',
+            '適用料率：' + df_room_sales_only['MKランク'].astype(str) + df_room_sales_only['個別ランク']
+        )
+
+        # 4. ルーム売上支払額の計算 (整数演算で一括計算、MKsoul行は支払額なし)
+        df_room_sales_only['支払額'] = room_sales_payouts(df_room_sales_only)
+
+    else:
+        notify('warning', "ルーム売上データ（「ルーム売上」データ種別）が存在しないため、ランク判定・支払額計算はスキップしました。")
+        mk_sales_total = 0 
+        mk_rank_value = get_mk_rank(mk_sales_total) 
+        notify('info', f"🔑 **MK全体分配額**: 0円 (→ **MKランク: {mk_rank_value}**)")
+
+        df_room_sales_only['MKランク'] = np.nan
+        df_room_sales_only['個別ランク'] = np.nan
+        df_room_sales_only['適用料率'] = '-'
+        df_room_sales_only['支払額'] = np.nan
+
+
+    # 5. その他の売上行のランク列を埋める
+    df_other_sales['MKランク'] = '-'
+    df_other_sales['個別ランク'] = '-'
+    df_other_sales['適用料率'] = '-'
+
+    # 6. その他の売上支払額の計算 (プレミアムライブ売上・タイムチャージ売上を整数演算で一括計算)
+    df_other_sales['支払額'] = other_sales_payouts(df_other_sales)
+
+    # 売上データがない行の支払額は0
+    no_sales_mask = df_other_sales['データ種別'] == '売上データなし'
+    df_other_sales.loc[no_sales_mask, '支払額'] = 0
+
+    # 7. 最終的なDataFrameを再結合
+    df_extracted = pd.concat([df_room_sales_only, df_other_sales], ignore_index=True)
+
+
+    # --- 繰越追加処理（ここから） ---
+    # 各ライバーの履歴ファイルを参照して、連続する繰越配信月分を取得し
+    # 同じ単月処理と同等の行を作成して df_extracted に追加する
+
+    # selected_month_label 例: '2025年10月分' -> 支払月 = 選択配信月 + 2ヶ月 -> 'YYYY/MM'
+    sel_info = get_month_info_by_label(selected_month_label)
+
+    if sel_info:
+        pay_month_str = sel_info.pay_month  # 履歴Excelの '支払月' と照合する形式
+
+        # df_livers は既にロード済み
+        if df_livers is not None:
+            df_livers_local = df_livers.copy()
+            if not df_livers_local.empty:
+                # 1ライバーずつ処理
+                n_livers = len(df_livers_local)
+                for liver_index, (_, liver_row) in enumerate(df_livers_local.iterrows()):
+                    if progress:
+                        progress(liver_index, n_livers)
+                    # 認証切れを検出したら残りのライバーは処理せず中断する (Cookie更新後の再実行で再開)
+                    if not offline and get_auth_breaker(cookie_string).is_open():
+                        if checkpoint:
+                            checkpoint.record_failure("auth", f"認証切れのため残り {n_livers - liver_index}件のライバーの繰越処理を中断しました")
+                        notify('error', "🚨 認証切れのため、残りのライバーの繰越処理を中断しました。Cookieを更新して再実行してください。")
+                        break
+                    # 実行全体の期限を過ぎたら残りのライバーは処理せず、結果を一部のみとする (再実行で再開)
+                    if not offline and deadline is not None and deadline.expired():
+                        deadline.hit = True
+                        if checkpoint:
+                            checkpoint.record_failure("deadline", f"実行全体の期限を過ぎたため残り {n_livers - liver_index}件のライバーの繰越処理を打ち切りました")
+                        notify('warning', "⏱️ 実行全体の期限を過ぎたため、残りのライバーの繰越処理を打ち切りました。再実行すると続きから処理します。")
+                        break
+                    file_basename = liver_row.get('ファイル名')
+                    room_id = str(liver_row.get('ルームID', '')).strip()
+                    if not file_basename or pd.isna(file_basename):
+                        continue
+
+                    months_list = checkpoint.get_liver(file_basename) if checkpoint else None
+                    if months_list is None and offline:
+                        if checkpoint:
+                            checkpoint.record_failure(RunCheckpoint.liver_step(file_basename), "オフラインのため履歴Excelを参照できません (繰越月は未解決)")
+                        continue
+                    if months_list is None:
+                        try:
+                            months_list = get_kurikoshi_months_from_excel(
+                                str(file_basename), pay_month_str, raise_on_error=checkpoint is not None, deadline=deadline
+                            )
+                        except PermanentFetchError:
+                            # 履歴Excelがまだない (404 等) ライバーは、従来どおり繰越なしとして扱う
+                            months_list = []
+                        except Exception as e:
+                            # 履歴Excelの取得失敗は黙って読み飛ばさず、失敗として記録する
+                            if checkpoint:
+                                checkpoint.record_failure(RunCheckpoint.liver_step(file_basename), f"履歴Excelの取得に失敗しました: {e}")
+                            continue
+                        if checkpoint:
+                            checkpoint.save_liver(file_basename, months_list)
+
+                    # months_list の先頭は今回処理済みの配信月（既に df_extracted に含まれている）
+                    if len(months_list) <= 1:
+                        continue
+                    months_to_add = months_list[1:]  # 例 ['2025/09','2025/08',...]
+
+                    for mstr in months_to_add:
+                        # mstr は 'YYYY/MM' 形式 -> メモ化済みの月テーブルからタイムスタンプを取得
+                        month_info = get_month_info_by_slash(mstr)
+                        if month_info is None:
+                            continue
+                        ts = month_info.timestamp
+
+                        # その月に関する SHOWROOM の3種データを取得（既存関数を再利用）
+                        # チェックポイントに保存済みの月は再取得しない
+                        df_room_month = fetch_with_checkpoint(checkpoint, ts, cookie_string, "room_sales", offline=offline, login_id=login_account_id, deadline=deadline, notify=notify)
+                        df_premium_month = fetch_with_checkpoint(checkpoint, ts, cookie_string, "premium_live", offline=offline, login_id=login_account_id, deadline=deadline, notify=notify)
+                        df_time_month = fetch_with_checkpoint(checkpoint, ts, cookie_string, "time_charge", offline=offline, login_id=login_account_id, deadline=deadline, notify=notify)
+
+                        # 取得失敗や None の場合は失敗として記録し、この月はスキップ (再実行時に再開)
+                        # 取得が再試行しても回復しない失敗 (404 等) の場合は、この月も回復しない失敗として記録する
+                        liver_month_step = f"{RunCheckpoint.liver_step(file_basename)}:{mstr}"
+                        if df_room_month is None or df_premium_month is None or df_time_month is None:
+                            if checkpoint:
+                                terminal = any(
+                                    checkpoint.is_terminal_failure(RunCheckpoint.fetch_step(key, ts))
+                                    for key in ("room_sales", "premium_live", "time_charge")
+                                )
+                                checkpoint.record_failure(liver_month_step, f"{month_info.label} の売上データを取得できませんでした", terminal=terminal)
+                            continue
+                        if checkpoint:
+                            checkpoint.clear_failure(liver_month_step)
+
+                        # MK全体合計は df_room_month の MKsoul 行から取得（既存ロジックに合わせる）
+                        try:
+                            mk_total = int(df_room_month[df_room_month['ルームID'] == 'MKsoul']['分配額'].iloc[0])
+                        except Exception:
+                            mk_total = 0
+                        mk_rank_value = get_mk_rank(mk_total)
+
+                        # 対象ライバーの行だけ抽出
+                        all_sales_month = pd.concat([df_room_month, df_premium_month, df_time_month], ignore_index=True)
+                        sel_rows = all_sales_month[all_sales_month['ルームID'] == room_id].copy()
+
+                        if sel_rows.empty:
+                            # 売上データなしの行を既存の形式に合わせて作る
+                            no_row = {
+                                'ルームID': room_id,
+                                '分配額': 0,
+                                'アカウントID': np.nan,
+                                'データ種別': '売上データなし',
+                                '配信月': month_info.label,
+                                'is_invoice_registered': bool(liver_row.get('is_invoice_registered', False))
+                            }
+                            df_add = pd.DataFrame([no_row])
+                        else:
+                            sel_rows['配信月'] = month_info.label
+                            sel_rows['is_invoice_registered'] = bool(liver_row.get('is_invoice_registered', False))
+
+                            # ルーム売上は個別ランク・MKランク・支払額を付与
+                            df_room_part = sel_rows[sel_rows['データ種別'] == 'ルーム売上'].copy()
+                            df_other_part = sel_rows[sel_rows['データ種別'] != 'ルーム売上'].copy()
+
+                            if not df_room_part.empty:
+                                df_room_part['MKランク'] = mk_rank_value
+                                df_room_part['個別ランク'] = df_room_part['分配額'].apply(get_individual_rank)
+                                df_room_part['適用料率'] = np.where(
+                                    df_room_part['ルームID'] == 'MKsoul',
+                                    '-',
+                                    '適用料率：' + df_room_part['MKランク'].astype(str) + df_room_part['個別ランク']
+                                )
+                                df_room_part['支払額'] = room_sales_payouts(df_room_part)
+                            else:
+                                df_room_part = pd.DataFrame(columns=sel_rows.columns.tolist() + ['MKランク','個別ランク','適用料率','支払額'])
+
+                            # その他（プレミアム/タイムチャージ）
+                            if not df_other_part.empty:
+                                df_other_part['MKランク'] = '-'
+                                df_other_part['個別ランク'] = '-'
+                                df_other_part['適用料率'] = '-'
+                                df_other_part['支払額'] = other_sales_payouts(df_other_part)
+                            else:
+                                df_other_part = pd.DataFrame(columns=sel_rows.columns.tolist() + ['MKランク','個別ランク','適用料率','支払額'])
+
+                            df_add = pd.concat([df_room_part, df_other_part], ignore_index=True)
+
+                        # 最終形式に沿って列を揃え、支払額の型を整える
+                        cols_to_keep = [c for c in ['ルームID','ファイル名','インボイス','is_invoice_registered','データ種別','分配額','個別ランク','MKランク','適用料率','支払額','アカウントID','配信月'] if c in df_add.columns]
+                        df_add = df_add[cols_to_keep]
+                        if '支払額' in df_add.columns:
+                            df_add['支払額'] = df_add['支払額'].replace(['#ERROR_CALC','#ERROR_MK','#ERROR_RANK','#N/A'], np.nan)
+                            df_add['支払額'] = pd.to_numeric(df_add['支払額'], errors='coerce').fillna(0).astype('Int64')
+
+                        # df_extracted に連結（既存の順序を崩さない）
+                        df_extracted = pd.concat([df_extracted, df_add], ignore_index=True)
+
+        # 失敗したステップを通知し、再試行で回復し得る失敗がなければ実行を完了扱いにする
+        if checkpoint:
+            failures = checkpoint.failures()
+            if failures:
+                # 失敗したステップの一覧は、ジョブの結果として render_job_status が表示する
+                notify('warning', f"⚠️ {len(failures)}件のステップが失敗しました。Cookieを更新して再実行すると、失敗したステップから再開します (再試行しても回復しない失敗は再開時にスキップします)。")
+            # 再試行で回復し得る失敗が残っていなければ完了扱いにする (次回の実行は新規に取得し直す)
+            if not checkpoint.has_retryable_failures():
+                checkpoint.mark_completed()
+
+    # --- 繰越追加処理（ここまで） ---
+
+
+
+    # 8. 不要な列を整理し、抽出が完了したDataFrameを表示 (ランク情報を追加)
+    final_display_cols = ['ルームID']
+    if 'ファイル名' in df_livers.columns:
+        final_display_cols.append('ファイル名')
+    if 'インボイス' in df_livers.columns:
+        final_display_cols.append('インボイス')
+
+    # is_invoice_registered列は、計算に使われた「真のブール値」を示すため、表示列に残します
+    final_display_cols.extend(['is_invoice_registered', 'データ種別', '分配額', '個別ランク', 'MKランク', '適用料率', '支払額', 'アカウントID', '配信月'])
+
+    # DataFrameに存在しない列を除外
+    df_extracted_cols = [col for col in final_display_cols if col in df_extracted.columns]
+    df_extracted = df_extracted[df_extracted_cols]
+
+    # 支払額列の表示形式を調整（整数としてNaN以外を扱う）
+    df_extracted['支払額'] = df_extracted['支払額'].replace(['#ERROR_CALC', '#ERROR_MK', '#ERROR_RANK', '#N/A'], np.nan)
+    df_extracted['支払額'] = pd.to_numeric(df_extracted['支払額'], errors='coerce').fillna(0).astype('Int64') # Int64でNaNを許容する整数型に
+
+    # ソートして見やすくする（オプション）
+    df_extracted = df_extracted.sort_values(by=['ルームID', 'データ種別'], ascending=[True, False]).reset_index(drop=True)
+
+    return df_extracted
+
+
+def build_payout_summary(df_extracted, selected_month_label):
+    """
+    最終DataFrameからライバー単位の支払サマリーを groupby で一括集計する
+    (データ種別別・配信月別の支払額合計、繰越月分の合計、インボイス登録フラグ)
+    """
+    key_cols = [c for c in ['ルームID', 'ファイル名'] if c in df_extracted.columns]
+    if df_extracted.empty or not key_cols:
+        return pd.DataFrame(columns=key_cols + ['インボイス登録', '分配額合計', '支払額合計', '繰越分支払額', '繰越月数'])
+
+    # 合計行 (MKsoul) はライバーではないため除外する
+    df = df_extracted[df_extracted['ルームID'] != 'MKsoul'].copy()
+    df['支払額'] = pd.to_numeric(df['支払額'], errors='coerce').fillna(0).astype('int64')
+    df['分配額'] = pd.to_numeric(df['分配額'], errors='coerce').fillna(0).astype('int64')
+    df['is_carried'] = df['配信月'] != selected_month_label
+    df['繰越分支払額'] = df['支払額'].where(df['is_carried'], 0)
+    # 繰越月数は繰越行の配信月のみを数える
+    df['繰越配信月'] = df['配信月'].where(df['is_carried'])
+    # 欠損したキー (ファイル名未設定など) でも集計結果どうしを結合できるよう、一時的に空文字へ置き換える
+    df[key_cols] = df[key_cols].fillna('').astype(str)
+
+    grouped = df.groupby(key_cols, sort=True)
+    summary = grouped.agg(
+        インボイス登録=('is_invoice_registered', 'any'),
+        分配額合計=('分配額', 'sum'),
+        支払額合計=('支払額', 'sum'),
+        繰越分支払額=('繰越分支払額', 'sum'),
+        繰越月数=('繰越配信月', 'nunique'),
+    )
+
+    # データ種別別・配信月別の支払額合計 (売上データなしの行は除く)
+    df_sales = df[df['データ種別'] != '売上データなし']
+    by_type = df_sales.pivot_table(index=key_cols, columns='データ種別', values='支払額', aggfunc='sum', fill_value=0)
+    by_type.columns = [f"{c}_支払額" for c in by_type.columns]
+    by_month = df.pivot_table(index=key_cols, columns='配信月', values='支払額', aggfunc='sum', fill_value=0)
+    by_month = by_month[sorted(by_month.columns, reverse=True)]
+    by_month.columns = [f"{c}_支払額" for c in by_month.columns]
+
+    summary = summary.join(by_type).join(by_month)
+    extra_cols = [c for c in summary.columns if c.endswith('_支払額')]
+    summary[extra_cols] = summary[extra_cols].fillna(0).astype('int64')
+    summary = summary.reset_index()
+    summary[key_cols] = summary[key_cols].replace('', np.nan)
+    return summary
+
+
+# --- 実行結果の履歴と差分 (前回の実行結果との比較用) ---
+# 抽出結果を行ハッシュ付きで保存するディレクトリと、実行キーごとに保持する件数
+RESULT_HISTORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".run_results")
+RESULT_HISTORY_LIMIT = 10
+# 行を識別するキー列 (ライバー × データ種別 × 配信月)
+RESULT_KEY_COLUMNS = ['ルームID', 'データ種別', '配信月']
+ROW_HASH_COLUMN = '_行ハッシュ'
+_ROW_OCCURRENCE_COLUMN = '_キー内連番'
+
+
+def result_key_columns(df):
+    """行を識別するキー列 (アカウント名の列がある結果ではそれも含める)"""
+    return ([ROSTER_ACCOUNT_COLUMN] if ROSTER_ACCOUNT_COLUMN in df.columns else []) + RESULT_KEY_COLUMNS
+
+
+def add_row_hashes(df):
+    """
+    キー列以外の値から計算した行ごとの64bitハッシュ列を付けた複製を返す
+    同じキーの行が複数ある場合に備え、キー内の連番も付ける (行の並び順が変わっても同じ連番になるよう、値で安定ソートしてから採番する)
+    """
+    df = df.drop(columns=[ROW_HASH_COLUMN, _ROW_OCCURRENCE_COLUMN], errors='ignore').reset_index(drop=True)
+    key_cols = result_key_columns(df)
+    value_cols = [c for c in df.columns if c not in key_cols]
+    # 型の違い (int64 / Int64 など) でハッシュが変わらないよう、文字列に揃えてから計算する
+    df_values = df[value_cols].astype(str)
+    df[ROW_HASH_COLUMN] = pd.util.hash_pandas_object(df_values, index=False).to_numpy()
+    ordered = df.loc[df_values.sort_values(value_cols, kind='mergesort').index] if value_cols else df
+    df[_ROW_OCCURRENCE_COLUMN] = ordered.groupby(key_cols, dropna=False).cumcount()
+    return df
+
+
+def diff_extracted_results(df_previous, df_current):
+    """
+    前回と今回の抽出結果をキー列で突き合わせ、追加・削除・変更された行を返す
+    キー列でのハッシュ結合と行ハッシュの比較のみで判定するため、行数に比例した時間で終わる
+    df_previous が None (前回の結果なし) の場合は None を返す
+    """
+    if df_previous is None:
+        return None
+    previous = df_previous if ROW_HASH_COLUMN in df_previous.columns else add_row_hashes(df_previous)
+    current = add_row_hashes(df_current)
+    key_cols = result_key_columns(current) + [_ROW_OCCURRENCE_COLUMN]
+    value_cols = [c for c in dict.fromkeys(list(previous.columns) + list(current.columns)) if c not in key_cols]
+    # 列構成が変わっていても比較できるよう、両方を同じ列に揃える
+    previous = previous.reindex(columns=key_cols + value_cols)
+    current = current.reindex(columns=key_cols + value_cols)
+
+    merged = previous.merge(current, on=key_cols, how='outer', suffixes=('_前回', '_今回'), indicator=True)
+    is_changed = (merged['_merge'] == 'both') & (merged[f'{ROW_HASH_COLUMN}_前回'] != merged[f'{ROW_HASH_COLUMN}_今回'])
+    merged = merged[(merged['_merge'] != 'both') | is_changed].reset_index(drop=True)
+
+    diff = merged[key_cols[:-1]].copy()
+    diff['変更種別'] = np.select(
+        [merged['_merge'] == 'left_only', merged['_merge'] == 'right_only'], ['削除', '追加'], default='変更'
+    )
+    diff['前回支払額'] = pd.to_numeric(merged['支払額_前回'], errors='coerce').astype('Int64')
+    diff['今回支払額'] = pd.to_numeric(merged['支払額_今回'], errors='coerce').astype('Int64')
+    diff['支払額差'] = diff['今回支払額'].fillna(0) - diff['前回支払額'].fillna(0)
+    # 変更された行のみ、値が異なる列名を列挙する
+    changed_cols = pd.Series('', index=merged.index)
+    for col in value_cols:
+        if col == ROW_HASH_COLUMN:
+            continue
+        differs = merged[f'{col}_前回'].astype(str) != merged[f'{col}_今回'].astype(str)
+        changed_cols = changed_cols.where(~differs, changed_cols + col + ' ')
+    diff['変更列'] = changed_cols.str.strip().where(diff['変更種別'] == '変更', '')
+    return diff.sort_values(by=['変更種別'] + key_cols[:-1]).reset_index(drop=True)
+
+
+def result_history_key(run_key):
+    """履歴の保存先 (オフライン再処理の結果もオンライン実行と同じ履歴で比較する)"""
+    run_key = str(run_key)
+    return run_key[:-len("_offline")] if run_key.endswith("_offline") else run_key
+
+
+def list_result_snapshots(run_key):
+    """保存済みの抽出結果のファイル名を古い順に返す"""
+    try:
+        return sorted(os.listdir(os.path.join(RESULT_HISTORY_DIR, result_history_key(run_key))))
+    except FileNotFoundError:
+        return []
+
+
+def load_result_snapshot(run_key, file_name=None):
+    """保存済みの抽出結果 (行ハッシュ付き) を返す。file_name 省略時は最新のもの、なければ None"""
+    if file_name is None:
+        snapshots = list_result_snapshots(run_key)
+        if not snapshots:
+            return None
+        file_name = snapshots[-1]
+    try:
+        return pd.read_pickle(os.path.join(RESULT_HISTORY_DIR, result_history_key(run_key), file_name))
+    except Exception as e:
+        logging.warning(f"保存済みの抽出結果を読み込めませんでした ({file_name}): {e}")
+        return None
+
+
+def save_result_snapshot(run_key, df_extracted):
+    """
+    抽出結果を行ハッシュ付きで履歴に保存し、RESULT_HISTORY_LIMIT 件を超えた古いものを削除する
+    保存の失敗は処理を止めない
+    """
+    try:
+        history_dir = os.path.join(RESULT_HISTORY_DIR, result_history_key(run_key))
+        os.makedirs(history_dir, exist_ok=True)
+        file_name = f"{datetime.now(JST).strftime('%Y%m%d%H%M%S%f')}.pkl.gz"
+        add_row_hashes(df_extracted).to_pickle(os.path.join(history_dir, file_name))
+        for old_name in list_result_snapshots(run_key)[:-RESULT_HISTORY_LIMIT]:
+            os.remove(os.path.join(history_dir, old_name))
+        return file_name
+    except Exception as e:
+        logging.warning(f"抽出結果の履歴保存に失敗しました ({run_key}): {e}")
+        return None
+
+
+# --- 支払額の列指向出力 (下流の集計用 Parquet) ---
+try:
+    _EXPORT_SETTINGS = dict(st.secrets.get("export", {}))
+except Exception:
+    _EXPORT_SETTINGS = {}
+# 出力先ディレクトリ (secrets の [export] parquet_dir で変更可能)
+PARQUET_EXPORT_DIR = _EXPORT_SETTINGS.get("parquet_dir") or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".payout_exports")
+PARQUET_SCHEMA_VERSION = "1"
+# データセットごとの固定スキーマ (列名, 型)。列を追加する場合は末尾に追加し、既存の列の型は変えない
+PAYOUT_PARQUET_COLUMNS = [
+    ('オーガナイザー', 'string'),
+    ('ルームID', 'string'),
+    ('ファイル名', 'string'),
+    ('インボイス', 'string'),
+    ('is_invoice_registered', 'bool'),
+    ('データ種別', 'string'),
+    ('分配額', 'int64'),
+    ('個別ランク', 'string'),
+    ('MKランク', 'string'),
+    ('適用料率', 'string'),
+    ('支払額', 'int64'),
+    ('アカウントID', 'string'),
+    ('配信月', 'string'),
+    ('支払月', 'string'),
+    ('実行キー', 'string'),
+    ('出力日時', 'timestamp'),
+]
+SALES_PARQUET_COLUMNS = [
+    ('オーガナイザー', 'string'),
+    ('ルームID', 'string'),
+    ('分配額', 'int64'),
+    ('アカウントID', 'string'),
+    ('データ種別', 'string'),
+    ('配信月', 'string'),
+    ('出力日時', 'timestamp'),
+]
+
+
+def _to_parquet_string(value):
+    """文字列列の値を正規化する (欠損は None、整数値の浮動小数点は '11.0' ではなく '11')"""
+    if value is None or value is pd.NA or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _to_arrow_table(df, columns, dataset):
+    """DataFrame を固定スキーマの Arrow テーブルに変換する (存在しない列は欠損値で埋める)"""
+    import pyarrow as pa
+
+    arrow_types = {
+        'string': pa.string(),
+        'int64': pa.int64(),
+        'bool': pa.bool_(),
+        'timestamp': pa.timestamp('us', tz='Asia/Tokyo'),
+    }
+    arrays = []
+    for name, type_name in columns:
+        series = df[name] if name in df.columns else pd.Series(None, index=df.index, dtype=object)
+        if type_name == 'string':
+            values = [_to_parquet_string(v) for v in series]
+        elif type_name == 'int64':
+            values = pd.to_numeric(series, errors='coerce').astype('Int64')
+        elif type_name == 'bool':
+            values = series.astype('boolean')
+        else:
+            values = pd.to_datetime(series)
+        arrays.append(pa.array(values, type=arrow_types[type_name]))
+    schema = pa.schema(
+        [(name, arrow_types[type_name]) for name, type_name in columns],
+        metadata={'dataset': dataset, 'schema_version': PARQUET_SCHEMA_VERSION},
+    )
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _write_parquet_atomic(table, path):
+    """書き込み途中のファイルを読まれないよう、一時ファイル経由で置き換える"""
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 一時ファイルは "." 始まりの名前にして、データセットの読み込み (pyarrow は "." / "_" 始まりを無視する) の対象外にする
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _safe_file_name(name):
+    return re.sub(r'[^\w@.-]', '_', str(name))
+
+
+def _month_partition(label):
+    info = get_month_info_by_label(label)
+    return f"ym={info.ym}" if info else "ym=unknown"
+
+
+def export_run_to_parquet(run_key, month_info, account_name, df_extracted, fetched_frames, export_dir=None):
+    """
+    1回の実行結果を配信月 (ym=YYYYMM) で分割した Parquet として出力し、書き込んだファイルのパスを返す
+    - payouts/ym=YYYYMM/<実行キー>.parquet: 支払額計算済みの明細 (繰越月の行はその配信月の区画に入る)
+    - sales/ym=YYYYMM/<アカウント名>.parquet: 取得した売上データ (月・アカウントごとに最新の取得分で置き換える)
+    同じ実行キーの再実行・オフライン再処理は、前回の出力を置き換える
+    fetched_frames: [(データ種別, タイムスタンプ, DataFrame)]
+    """
+    export_dir = export_dir or PARQUET_EXPORT_DIR
+    history_key = result_history_key(run_key)
+    account = account_name if account_name is not None else ORGANIZER_ACCOUNTS[0].name
+    exported_at = datetime.now(JST)
+    written = []
+
+    payouts_dir = os.path.join(export_dir, "payouts")
+    payout_file = f"{_safe_file_name(history_key)}.parquet"
+    if df_extracted is not None and not df_extracted.empty:
+        df = df_extracted.assign(
+            オーガナイザー=account,
+            支払月=month_info.pay_month,
+            実行キー=history_key,
+            出力日時=exported_at,
+        )
+        for partition, df_part in df.groupby(df['配信月'].map(_month_partition), sort=True):
+            path = os.path.join(payouts_dir, partition, payout_file)
+            _write_parquet_atomic(_to_arrow_table(df_part, PAYOUT_PARQUET_COLUMNS, "payouts"), path)
+            written.append(path)
+    # 前回の同じ実行で出力し、今回は出力しなかった区画 (繰越月が減った場合など) のファイルを削除する
+    if os.path.isdir(payouts_dir):
+        for partition in os.listdir(payouts_dir):
+            stale_path = os.path.join(payouts_dir, partition, payout_file)
+            if stale_path not in written and os.path.exists(stale_path):
+                os.remove(stale_path)
+
+    # 取得した売上データは配信月ごとに3種別をまとめて1ファイルにする
+    sales_by_month = {}
+    for data_type_key, timestamp, df_sales in fetched_frames:
+        info = get_month_info_by_timestamp(timestamp)
+        sales_by_month.setdefault(info, []).append(df_sales)
+    for info, frames in sorted(sales_by_month.items()):
+        df = pd.concat(frames, ignore_index=True).assign(
+            オーガナイザー=account,
+            配信月=info.label,
+            出力日時=exported_at,
+        )
+        path = os.path.join(export_dir, "sales", f"ym={info.ym}", f"{_safe_file_name(account)}.parquet")
+        _write_parquet_atomic(_to_arrow_table(df, SALES_PARQUET_COLUMNS, "sales"), path)
+        written.append(path)
+    return written
+
+
+def read_exported_parquet(dataset="payouts", yms=None, export_dir=None):
+    """
+    出力済みの Parquet (payouts / sales) を読み込む (下流の集計スクリプト用)
+    yms: 読み込む配信月 ('YYYYMM') のリスト。指定した区画のファイルのみをメモリマップで読む
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    path = os.path.join(export_dir or PARQUET_EXPORT_DIR, dataset)
+    columns = PAYOUT_PARQUET_COLUMNS if dataset == "payouts" else SALES_PARQUET_COLUMNS
+    if not os.path.isdir(path):
+        return pd.DataFrame(columns=[name for name, _ in columns] + ['ym'])
+    table = pq.read_table(
+        path,
+        partitioning=ds.partitioning(pa.schema([('ym', pa.string())]), flavor='hive'),
+        filters=[('ym', 'in', [str(ym) for ym in yms])] if yms else None,
+        memory_map=True,
+    )
+    # 欠損を含む整数列 (支払額など) も浮動小数点にせず Int64 で返す
+    return table.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+
+
+# --- バックグラウンドジョブ (取得パイプラインをUIスレッドの外で実行) ---
+# 同時に実行するジョブ数と、保持する終了済みジョブ数
+JOB_MAX_WORKERS = int(_LIMITS.get("job_max_workers", 2))
+JOB_HISTORY_LIMIT = 20
+# 実行中ジョブの進捗を再表示する間隔 (秒)
+JOB_POLL_INTERVAL_SECONDS = 2.0
+
+
+class PipelineJob:
+    """バックグラウンドで実行する1回分の取得・抽出処理 (状態・進捗・結果を保持する)"""
+
+    def __init__(self, job_key, label):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.job_key = job_key
+        self.label = label
+        self.status = 'queued'   # queued / running / done / failed
+        self.stage = '待機中'
+        self.progress = 0.0
+        self.messages = []
+        self.result = None
+        self.error = None
+        self.created_at = datetime.now(JST)
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_active(self):
+        return self.status in ('queued', 'running')
+
+    def update(self, stage, progress=None):
+        with self._lock:
+            self.stage = stage
+            if progress is not None:
+                self.progress = min(max(float(progress), 0.0), 1.0)
+
+    def log(self, message):
+        with self._lock:
+            self.messages.append(f"{datetime.now(JST).strftime('%H:%M:%S')} {message}")
+        logging.info(f"[ジョブ {self.job_id}] {message}")
+
+    def notify(self, level, message):
+        """
+        取得・抽出処理のメッセージ (level, message) を処理ログに追記する
+        ジョブのスレッドからは Streamlit に表示できないため、notify 引数にはこれを渡す
+        """
+        self.log(str(message).replace('**', ''))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'ジョブID': self.job_id,
+                '対象': self.label,
+                '状態': self.status,
+                '工程': self.stage,
+                '進捗': f"{self.progress:.0%}",
+                '開始': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+                '終了': self.finished_at.strftime('%Y-%m-%d %H:%M:%S') if self.finished_at else '',
+            }
+
+
+class JobRunner:
+    """
+    プロセス全体で共有するジョブ表とワーカースレッド
+    同じ job_key のジョブが実行中なら新規に投入せず、そのジョブを返す
+    """
+
+    def __init__(self, max_workers):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline-job")
+        self._lock = threading.Lock()
+        self._jobs = {}  # job_id -> PipelineJob (投入順)
+
+    def submit(self, job_key, label, fn, *args, **kwargs):
+        with self._lock:
+            for job in self._jobs.values():
+                if job.job_key == job_key and job.is_active:
+                    return job
+            job = PipelineJob(job_key, label)
+            self._jobs[job.job_id] = job
+            self._prune_history()
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        job.status = 'running'
+        try:
+            job.result = fn(job, *args, **kwargs)
+            job.update('完了', 1.0)
+            status = 'done'
+        except Exception as e:
+            job.error = str(e)
+            job.log(f"失敗しました: {e}")
+            status = 'failed'
+            logging.error(f"ジョブ {job.job_id} が失敗しました", exc_info=True)
+        # 終了時刻を先に記録してから状態を切り替える (表示側が終了時刻を参照するため)
+        job.finished_at = datetime.now(JST)
+        job.status = status
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def latest(self, job_key, status=None):
+        """指定キーの最新ジョブを返す (status を指定した場合はその状態のもののみ)"""
+        with self._lock:
+            for job in reversed(list(self._jobs.values())):
+                if job.job_key == job_key and (status is None or job.status == status):
+                    return job
+        return None
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _prune_history(self):
+        finished = [j for j in self._jobs.values() if not j.is_active]
+        for job in finished[:max(0, len(finished) - JOB_HISTORY_LIMIT)]:
+            del self._jobs[job.job_id]
+
+
+@st.cache_resource
+def get_job_runner():
+    """全セッションで共有するジョブ実行器 (プロセスに1つ)"""
+    # 共有リソースをジョブのスレッドで初めて作成すると ScriptRunContext がない旨の警告が出るため、画面側で先に作成しておく
+    get_shared_fetch_cache()
+    get_hedge_executor()
+    get_auth_probe_cache()
+    _get_auth_breaker_registry()
+    _get_run_checkpoint_registry()
+    _get_pipeline_flights()
+    get_history_ledger()
+    return JobRunner(JOB_MAX_WORKERS)
+
+
+def pipeline_run_key(month_info, account_name=None):
+    """チェックポイントの実行キー (既定のアカウントは従来どおり配信月のみ、他のアカウントは配信月@アカウント名)"""
+    if account_name is None or account_name == ORGANIZER_ACCOUNTS[0].name:
+        return month_info.ym
+    return f"{month_info.ym}@{account_name}"
+
+
+@st.cache_resource
+def _get_pipeline_flights():
+    """実行中の取得・抽出処理の待ち合わせ表 (結果は保持せず、同じ実行キーの同時実行だけを1回にまとめる)"""
+    return SingleFlightCache(0)
+
+
+def run_fetch_pipeline(job, month_info, cookie_string, login_id, offline_mode=False, discard_checkpoint=False, account_name=None):
+    """
+    データ取得・抽出の全工程 (ライバー読込 → 選択月の取得 → 繰越解決・支払額計算 → サマリー) を実行する
+    バックグラウンドのジョブとして実行し、進捗は job に報告、結果は辞書で返す
+    account_name: 処理するオーガナイザーアカウント名 (指定時はチェックポイントを分け、ライバーを担当分に絞り込む)
+    同じ実行キー (配信月・アカウント) の処理が他のジョブで実行中なら、チェックポイントを同時に書き換えないよう完了を待ってその結果を使う
+    (選択したアカウントの組み合わせが異なるジョブどうしでも、アカウント単位でまとめる)
+    """
+    run_key = pipeline_run_key(month_info, account_name)
+    result, shared = _get_pipeline_flights().get_or_compute(
+        (run_key, bool(offline_mode)),
+        lambda: _run_fetch_pipeline_unshared(job, month_info, cookie_string, login_id, offline_mode, discard_checkpoint, account_name)
+    )
+    if shared:
+        job.log("♻️ 同じ配信月・アカウントの処理が他のジョブで実行中だったため、その結果を使用しました。")
+    return result
+
+
+def _run_fetch_pipeline_unshared(job, month_info, cookie_string, login_id, offline_mode, discard_checkpoint, account_name):
+    """run_fetch_pipeline の本体 (同じ実行キーの同時実行の待ち合わせを経由しない)"""
+    run_key = pipeline_run_key(month_info, account_name)
+    if offline_mode:
+        # オフライン再処理: 毎回新しいチェックポイントに、アーカイブからの再抽出結果を格納する
+        checkpoint = get_run_checkpoint(f"{run_key}_offline")
+        checkpoint.clear()
+        # オンライン実行で解決済みの繰越月があれば引き継ぐ (履歴Excelへは接続しない)
+        for file_basename, months_list in get_run_checkpoint(run_key).livers().items():
+            checkpoint.save_liver(file_basename, months_list)
+    else:
+        # 実行チェックポイントの準備 (完了済みの実行は新規扱い、未完了の実行は再開)
+        checkpoint = get_run_checkpoint(run_key)
+        if discard_checkpoint or checkpoint.is_completed():
+            checkpoint.clear()
+        elif checkpoint.has_progress():
+            job.log(f"♻️ 前回中断した実行 ({month_info.label}) のチェックポイントから再開します。")
+
+    # バッチを始める前に認証を確認し、認証切れなら何も取得せずに中止する
+    if not offline_mode:
+        job.update('認証の確認', 0.02)
+        auth_ok, auth_reason = probe_auth(cookie_string)
+        if auth_ok is False:
+            raise RuntimeError(f"認証切れです。Cookieが古いか無効になっています ({auth_reason})。Cookieを更新してから再実行してください。")
+        if auth_ok is None:
+            job.log(f"⚠️ {auth_reason} (取得時に改めて確認します)")
+        else:
+            job.log("🔑 認証を確認しました。")
+        # 前回の実行で記録された認証切れの失敗は、認証確認の成功で解除する
+        checkpoint.clear_failure("auth")
+
+    # 実行全体の期限 (過ぎた時点で残りの取得を打ち切り、結果を一部のみとする)
+    deadline = RunDeadline(None if offline_mode else RUN_DEADLINE_SECONDS)
+    checkpoint.clear_failure("deadline")
+
+    # 処理対象ライバーファイルの読み込み (処理の流れ ③)
+    job.update('処理対象ライバーファイルの読み込み', 0.05)
+    if offline_mode:
+        df_livers = load_target_livers_snapshot()
+        if not df_livers.empty:
+            job.log(f"保存済みの処理対象ライバーデータ ({len(df_livers)}件) を使用します。")
+    else:
+        df_livers = load_target_livers(TARGET_LIVER_FILE_URL, notify=job.notify)
+        if not df_livers.empty:
+            save_target_livers_snapshot(df_livers)
+    if df_livers.empty:
+        raise RuntimeError("処理対象ライバーファイルが読み込めなかったため、処理を中断しました。")
+    job.log(f"処理対象ライバー {len(df_livers)}件を読み込みました。")
+    df_livers = filter_livers_for_account(df_livers, account_name)
+    if account_name is not None:
+        job.log(f"アカウント「{account_name}」の担当ライバー {len(df_livers)}件を処理します。")
+
+    if offline_mode:
+        job.update('アーカイブ済みHTMLの再抽出', 0.1)
+        # 再抽出するのは選択月と、オンライン実行で解決済みの繰越月のページのみ
+        target_timestamps = {int(month_info.timestamp)}
+        for months_list in checkpoint.livers().values():
+            for mstr in months_list[1:]:
+                carry_info = get_month_info_by_slash(mstr)
+                if carry_info is not None:
+                    target_timestamps.add(int(carry_info.timestamp))
+        entries = [
+            entry for entry in list_archived_pages(account=cookie_fingerprint(cookie_string))
+            if int(entry['timestamp']) in target_timestamps
+        ]
+        if not entries:
+            raise RuntimeError(f"{month_info.label} のアーカイブ済みHTMLがありません。一度オンラインで実行してください。")
+        reprocessed, messages = reprocess_archive(entries, login_id)
+        for (data_type_key, ts), df in reprocessed.items():
+            if df is not None:
+                checkpoint.save_fetch(data_type_key, ts, df)
+        # 再抽出時の警告・エラーはログに出力し、画面には件数のみ表示する
+        problems = [message for level, message in messages if level in ('warning', 'error')]
+        for message in problems:
+            logging.warning(f"[アーカイブ再抽出] {message}")
+        job.log(f"🗄️ アーカイブ {len(entries)}件を再抽出しました (成功: {sum(1 for df in reprocessed.values() if df is not None)}件, 警告・エラー: {len(problems)}件)。")
+
+    # --- 選択月の売上データの取得 (処理の流れ ④) ---
+    frames = {}
+    for i, data_type_key in enumerate(DATA_TYPES):
+        job.update(f"{month_info.label} {DATA_TYPES[data_type_key]['label']}の取得", 0.15 + 0.05 * i)
+        df = fetch_with_checkpoint(checkpoint, month_info.timestamp, cookie_string, data_type_key, offline=offline_mode, login_id=login_id, deadline=deadline, notify=job.notify)
+        if df is None:
+            job.log(f"⚠️ {DATA_TYPES[data_type_key]['label']} を取得できませんでした。")
+            df = pd.DataFrame(columns=['ルームID', '分配額', 'アカウントID', 'データ種別'])
+        frames[data_type_key] = df
+
+    all_sales_data = pd.concat([frames["room_sales"], frames["premium_live"], frames["time_charge"]])
+
+    # --- 繰越月の解決・ランク判定・支払額計算 ---
+    df_extracted = None
+    df_summary = None
+    df_diff = None
+    if not all_sales_data.empty:
+        if not offline_mode and 'ファイル名' in df_livers.columns:
+            # 履歴Excelは更新されたものだけを台帳に取り込み、全ライバーの繰越月を台帳への1回の問い合わせで解決する
+            job.update('支払履歴台帳の同期', 0.25)
+            counts = resolve_carryover_with_ledger(checkpoint, df_livers['ファイル名'].tolist(), month_info.pay_month, deadline)
+            job.log(
+                f"📒 支払履歴台帳: 取り込み {counts['ingested']}件 / 未更新 {counts['not_modified']}件 / "
+                f"ツールの記録を使用 {counts['tool']}件 / 失敗 {counts['failed']}件"
+            )
+        job.update('繰越月の解決・支払額計算', 0.3)
+        df_extracted = build_extracted_data(
+            df_livers,
+            all_sales_data,
+            frames["room_sales"],
+            month_info.label,
+            login_id,
+            cookie_string,
+            checkpoint,
+            offline=offline_mode,
+            progress=lambda done, total: job.update(
+                f"繰越月の解決・支払額計算 ({done}/{total})", 0.3 + 0.65 * done / max(total, 1)
+            ),
+            deadline=deadline,
+            notify=job.notify,
+        )
+        job.update('ライバー別サマリーの集計', 0.97)
+        df_summary = build_payout_summary(df_extracted, month_info.label)
+        job.log(f"✅ {len(df_extracted)}件の売上明細行の抽出が完了しました。")
+
+        # 解決した繰越月を台帳にツールの記録として書き込み、同じ支払月の再実行では履歴Excelを参照しないようにする
+        if not offline_mode:
+            n_rows = get_history_ledger().record_payout_run(month_info.pay_month, checkpoint.livers())
+            job.log(f"📒 支払履歴台帳に {n_rows}行を記録しました (支払月: {month_info.pay_month})。")
+
+    # 期限による打ち切りが1回でもあれば、結果は一部のみとして扱う
+    partial = deadline.hit
+    if partial:
+        job.log(f"⏱️ 実行全体の期限 ({RUN_DEADLINE_SECONDS:g}秒) に達したため、結果は一部のみです。再実行すると続きから処理します。")
+
+    if df_extracted is not None:
+        # 前回の実行結果と行ハッシュで比較する (一部のみの結果は履歴に保存しない)
+        job.update('前回の実行結果との比較', 0.99)
+        df_diff = diff_extracted_results(load_result_snapshot(checkpoint.run_key), df_extracted)
+        if not partial:
+            save_result_snapshot(checkpoint.run_key, df_extracted)
+        if df_diff is None:
+            job.log("前回の実行結果がないため、差分は次回の実行から表示します。")
+        else:
+            counts = df_diff['変更種別'].value_counts()
+            job.log(f"🔍 前回の実行結果との差分: 追加 {counts.get('追加', 0)}件 / 削除 {counts.get('削除', 0)}件 / 変更 {counts.get('変更', 0)}件")
+
+        # 下流の集計用に、配信月で分割した Parquet を出力する (出力の失敗で処理は止めない)
+        job.update('Parquet の出力', 0.995)
+        if partial:
+            job.log("⚠️ 結果が一部のみのため、Parquet の出力 (前回の出力の置き換え) はスキップしました。")
+        else:
+            try:
+                paths = export_run_to_parquet(checkpoint.run_key, month_info, account_name, df_extracted, checkpoint.fetched_frames())
+                job.log(f"📦 Parquet を {len(paths)}ファイル出力しました ({PARQUET_EXPORT_DIR})")
+            except ImportError:
+                job.log("⚠️ pyarrow がインストールされていないため、Parquet の出力をスキップしました。")
+            except Exception as e:
+                job.log(f"⚠️ Parquet の出力に失敗しました: {e}")
+                logging.error("Parquet 出力エラー", exc_info=True)
+    else:
+        job.log("結合対象の売上データがありません。")
+
+    return {
+        'run_key': checkpoint.run_key,
+        'run_keys': {account_name: checkpoint.run_key},
+        'account_names': [account_name] if account_name is not None else [],
+        'offline_mode': offline_mode,
+        'selected_month_label': month_info.label,
+        'df_livers': df_livers,
+        'df_room_sales': frames["room_sales"],
+        'df_premium_live': frames["premium_live"],
+        'df_time_charge': frames["time_charge"],
+        'df_extracted': df_extracted,
+        'df_summary': df_summary,
+        'df_diff': df_diff,
+        'failures': checkpoint.failures(),
+        'partial': partial,
+    }
+
+
+# 複数アカウントを同時に処理する際の並列数
+MULTI_ACCOUNT_MAX_WORKERS = int(_LIMITS.get("multi_account_max_workers", 4))
+
+
+class _AccountJobView:
+    """アカウント別の処理の進捗・ログを、親ジョブに [アカウント名] 付きで集約する"""
+
+    def __init__(self, job, account_name, progress_table):
+        self._job = job
+        self.account_name = account_name
+        self._progress_table = progress_table
+
+    def update(self, stage, progress=None):
+        if progress is not None:
+            self._progress_table[self.account_name] = float(progress)
+        overall = sum(self._progress_table.values()) / len(self._progress_table)
+        self._job.update(f"[{self.account_name}] {stage}", overall)
+
+    def log(self, message):
+        self._job.log(f"[{self.account_name}] {message}")
+
+    def notify(self, level, message):
+        self._job.notify(level, f"[{self.account_name}] {message}")
+
+
+def _with_account_column(df, account_name):
+    """先頭にアカウント名の列を付けた複製を返す"""
+    if df is None:
+        return None
+    df = df.drop(columns=[ROSTER_ACCOUNT_COLUMN], errors='ignore')
+    df.insert(0, ROSTER_ACCOUNT_COLUMN, account_name)
+    return df
+
+
+def combine_account_results(month_info, results, errors=None):
+    """
+    アカウント別のパイプライン結果を、アカウント名の列を付けて1つの結果に結合する
+    MK全体分配額・MKランクはアカウントごとに計算済みのまま保持する
+    """
+    combined = {
+        'run_key': "+".join(result['run_key'] for result in results),
+        'run_keys': {name: key for result in results for name, key in result['run_keys'].items()},
+        'account_names': [result['account_names'][0] for result in results],
+        'offline_mode': results[0]['offline_mode'],
+        'selected_month_label': month_info.label,
+        'failures': {},
+        'partial': any(result['partial'] for result in results),
+    }
+    for frame_key in ('df_livers', 'df_room_sales', 'df_premium_live', 'df_time_charge', 'df_extracted', 'df_summary', 'df_diff'):
+        frames = [_with_account_column(result[frame_key], result['account_names'][0]) for result in results]
+        frames = [df for df in frames if df is not None]
+        combined[frame_key] = pd.concat(frames, ignore_index=True) if frames else None
+    for result in results:
+        for step, info in result['failures'].items():
+            combined['failures'][f"{result['account_names'][0]}:{step}"] = info
+    for account_name, error in (errors or {}).items():
+        combined['failures'][f"{account_name}:pipeline"] = {
+            'reason': error,
+            'at': datetime.now(JST).strftime('%Y-%m-%d %H:%M:%S'),
+        }
+    return combined
+
+
+def run_multi_account_pipeline(job, month_info, accounts, offline_mode=False, discard_checkpoint=False):
+    """
+    複数のオーガナイザーアカウントの取得・抽出を並列に実行し、結果を結合して返す
+    各アカウントは独立した認証セッション・チェックポイントで処理し、ライバーファイルと履歴Excelの取得は共有キャッシュで1回にまとめる
+    """
+    progress_table = {account.name: 0.0 for account in accounts}
+    results = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=min(len(accounts), MULTI_ACCOUNT_MAX_WORKERS), thread_name_prefix="pipeline-account") as executor:
+        futures = {
+            executor.submit(
+                run_fetch_pipeline,
+                _AccountJobView(job, account.name, progress_table),
+                month_info,
+                account.cookie_string,
+                account.login_id,
+                offline_mode=offline_mode,
+                discard_checkpoint=discard_checkpoint,
+                account_name=account.name,
+            ): account
+            for account in accounts
+        }
+        for future in as_completed(futures):
+            account = futures[future]
+            try:
+                results[account.name] = future.result()
+            except Exception as e:
+                # 1つのアカウントの失敗で他のアカウントの結果を捨てない
+                errors[account.name] = str(e)
+                job.log(f"🚨 [{account.name}] 失敗しました: {e}")
+                logging.error(f"アカウント {account.name} の処理が失敗しました", exc_info=True)
+
+    if not results:
+        raise RuntimeError("全てのアカウントの処理が失敗しました。" + " / ".join(f"{name}: {error}" for name, error in errors.items()))
+    job.log(f"✅ {len(results)}/{len(accounts)}件のアカウントの処理が完了しました。")
+    return combine_account_results(month_info, [results[account.name] for account in accounts if account.name in results], errors)
+
+
+def load_job_result_into_session(job):
+    """完了したジョブの結果をこのセッションの表示用ステートに取り込む (他セッションのジョブも可)"""
+    result = job.result
+    st.session_state['df_livers'] = result['df_livers']
+    st.session_state['df_room_sales'] = result['df_room_sales']
+    st.session_state['df_premium_live'] = result['df_premium_live']
+    st.session_state['df_time_charge'] = result['df_time_charge']
+    st.session_state['run_key'] = result['run_key']
+    st.session_state['run_keys'] = result['run_keys']
+    st.session_state['account_names'] = result['account_names']
+    st.session_state['offline_mode'] = result['offline_mode']
+    st.session_state['df_diff'] = result['df_diff']
+    # 抽出結果のキャッシュキーに (実行キー, ジョブID) を使い、表示時に再計算しないようにする
+    st.session_state['run_token'] = job.job_id
+    st.session_state['result_month_label'] = result['selected_month_label']
+    if result['df_extracted'] is not None:
+        st.session_state['extracted_cache'] = {
+            'key': (result['run_key'], job.job_id),
+            'df': result['df_extracted'],
+            'summary': result['df_summary'],
+        }
+    st.session_state['loaded_job_id'] = job.job_id
+
+
+def render_job_status(job):
+    """ジョブの進捗・ログ・失敗ステップを表示する"""
+    if job.is_active:
+        st.progress(job.progress, text=f"⏳ 処理中 ({job.label}): {job.stage}")
+        st.caption(f"処理はバックグラウンドで実行されています。ブラウザを再読み込みしても中断されません。(ジョブID: {job.job_id})")
+    elif job.status == 'failed':
+        st.error(f"🚨 ジョブが失敗しました ({job.label}): {job.error}")
+    else:
+        st.success(f"🎉 **{job.label}の取得・抽出が完了しました** (ジョブID: {job.job_id}, 完了: {job.finished_at.strftime('%H:%M:%S')})")
+
+    if job.messages:
+        with st.expander("処理ログ", expanded=job.status == 'failed'):
+            st.text("\n".join(job.messages[-200:]))
+
+    if (job.result or {}).get('partial'):
+        st.warning(f"⏱️ 実行全体の期限 ({RUN_DEADLINE_SECONDS:g}秒) に達したため、結果は**一部のみ**です。再実行すると、打ち切られたステップから処理します。")
+
+    failures = (job.result or {}).get('failures') or {}
+    if failures:
+        st.warning(f"⚠️ {len(failures)}件のステップが失敗しました。Cookieを更新して再実行すると、失敗したステップから再開します (再試行しても回復しない失敗は再開時にスキップします)。")
+        st.dataframe(pd.DataFrame(
+            [{'ステップ': step, '理由': info.get('reason'), '日時': info.get('at'), '再試行': '不可' if info.get('terminal') else '可'} for step, info in failures.items()]
+        ), height=150)
+
 
 # --- Streamlit UI ---
 
+# ページ分割表示で絞り込みに使う列 (部分一致検索 / 選択式)
+PAGED_VIEW_SEARCH_COLUMNS = ['ルームID', 'ファイル名']
+PAGED_VIEW_SELECT_COLUMNS = [ROSTER_ACCOUNT_COLUMN, '変更種別', 'データ種別', '配信月']
+PAGED_VIEW_PAGE_SIZES = [50, 100, 200, 500]
+
+
+def filter_dataframe_for_view(df, search_terms=None, selections=None):
+    """
+    表示用の絞り込みをサーバー側で行う
+    search_terms: {列名: 部分一致文字列}, selections: {列名: 選択された値のリスト}
+    """
+    mask = pd.Series(True, index=df.index)
+    for col, term in (search_terms or {}).items():
+        term = str(term).strip()
+        if term and col in df.columns:
+            mask &= df[col].astype(str).str.contains(term, case=False, regex=False, na=False)
+    for col, values in (selections or {}).items():
+        if values and col in df.columns:
+            mask &= df[col].astype(str).isin([str(v) for v in values])
+    return df[mask]
+
+
+def render_paged_dataframe(df, key, height=None):
+    """
+    DataFrameを絞り込み・ページ分割して表示する
+    ブラウザへ送るのは表示中のページ分のみとし、大量行でも再描画を軽く保つ
+    """
+    if df is None or df.empty:
+        st.dataframe(df, height=height)
+        return
+
+    search_cols = [c for c in PAGED_VIEW_SEARCH_COLUMNS if c in df.columns]
+    select_cols = [c for c in PAGED_VIEW_SELECT_COLUMNS if c in df.columns]
+
+    search_terms = {}
+    selections = {}
+    filter_cols = search_cols + select_cols
+    if filter_cols:
+        widget_cols = st.columns(len(filter_cols))
+        for widget_col, col in zip(widget_cols, filter_cols):
+            with widget_col:
+                if col in search_cols:
+                    search_terms[col] = st.text_input(f"{col}で検索", key=f"{key}_search_{col}")
+                else:
+                    options = sorted(df[col].dropna().astype(str).unique().tolist())
+                    selections[col] = st.multiselect(col, options=options, key=f"{key}_select_{col}")
+
+    df_view = filter_dataframe_for_view(df, search_terms, selections)
+    total_rows = len(df_view)
+
+    size_col, page_col, info_col = st.columns([1, 1, 2])
+    with size_col:
+        page_size = st.selectbox("表示件数", options=PAGED_VIEW_PAGE_SIZES, key=f"{key}_page_size")
+    total_pages = max(1, -(-total_rows // page_size))
+    page_key = f"{key}_page"
+    # 絞り込みで総ページ数が減った場合に範囲外のページ番号が残らないよう補正する
+    if st.session_state.get(page_key, 1) > total_pages:
+        st.session_state[page_key] = total_pages
+    with page_col:
+        page = st.number_input("ページ", min_value=1, max_value=total_pages, step=1, key=page_key)
+    page = min(int(page), total_pages)
+    start = (page - 1) * page_size
+    end = min(start + page_size, total_rows)
+    with info_col:
+        st.caption(f"全 {len(df):,}件中 絞り込み後 {total_rows:,}件 / {start + 1 if total_rows else 0:,}〜{end:,}件目を表示 ({page}/{total_pages}ページ)")
+
+    st.dataframe(df_view.iloc[start:end], height=height)
+
+
 
 # -------------------------
 # ヘルパー: 履歴Excelから「最新支払行」起点で連続する繰越配信月を取得する
 # -------------------------
-def get_kurikoshi_months_from_excel(file_basename, target_payment_month_str):
+def get_kurikoshi_months_from_excel(file_basename, target_payment_month_str, raise_on_error=False, deadline=None):
     """
     file_basename: '350565_emily' のようにファイル名部分（拡張子無し）
     target_payment_month_str: 'YYYY/MM' (例 '2025/12')  --- 履歴内の '支払月' と合わせる形式
+    raise_on_error: True の場合、Excelの取得/解析失敗を空リストにせず例外として送出する
+    deadline: 実行全体の期限 (RunDeadline)
     戻り値: ['YYYY/MM', 'YYYY/MM', ...] 最新(今回支払) → 古い 順で返す
+    同じライバー・支払月の解決はプロセス全体で1回にまとめ、結果を共有する
     """
-    import pandas as _pd
-    import requests as _req
-    import io as _io
+    cache_key = ("workbook", str(file_basename), str(target_payment_month_str))
+    try:
+        months, _ = get_shared_fetch_cache().get_or_compute(
+            cache_key,
+            lambda: _get_kurikoshi_months_uncached(file_basename, target_payment_month_str, raise_on_error=True, deadline=deadline)
+        )
+    except Exception:
+        if raise_on_error:
+            raise
+        return []
+    return list(months)
 
-    url_xlsx = f"https://mksoul-pro.com/showroom/csv/uriage_{file_basename}.xlsx"
+
+def _get_kurikoshi_months_uncached(file_basename, target_payment_month_str, raise_on_error=False, deadline=None):
+    """
+    支払履歴台帳から繰越配信月を解決する (共有キャッシュを経由しない)
+    履歴Excelを (更新時のみ) 取り込んでから問い合わせる。ツール自身が記録した支払行は、
+    履歴Excelが更新されていないか取得できない場合にそのまま使われる
+    """
+    file_basename = str(file_basename)
+    ledger = get_history_ledger()
     try:
-        r = _req.get(url_xlsx, timeout=15)
-        r.raise_for_status()
-        df_hist = _pd.read_excel(_io.BytesIO(r.content))
+        status = sync_workbook_into_ledger(ledger, file_basename, raise_on_error=raise_on_error, deadline=deadline)
     except Exception:
-        # Excel取得/解析に失敗したら空で返す（PDF対応は必要なら別途実装）
+        # 履歴Excelを取得できない場合は、ツールの記録があればそれを使う
+        resolved = ledger.carryover_months(target_payment_month_str, file_basename).get(file_basename)
+        if resolved and resolved['from_tool']:
+            return resolved['months']
+        raise
+    resolved = ledger.carryover_months(target_payment_month_str, file_basename).get(file_basename)
+    if status == 'failed' and not (resolved and resolved['from_tool']):
         return []
+    return resolved['months'] if resolved else []
+
+
+# --- 支払履歴台帳 (履歴Excelの内容をSQLiteに保持し、繰越月をインデックス付きの問い合わせで解決する) ---
+try:
+    _LEDGER_SETTINGS = dict(st.secrets.get("ledger", {}))
+except Exception:
+    _LEDGER_SETTINGS = {}
+# 台帳ファイル (secrets の [ledger] path で変更可能)
+HISTORY_LEDGER_PATH = _LEDGER_SETTINGS.get("path") or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".history_ledger.sqlite3")
+# 履歴Excelの更新確認 (条件付き取得) を並列に行う数
+LEDGER_SYNC_WORKERS = int(_LIMITS.get("ledger_sync_workers", 8))
+HISTORY_WORKBOOK_URL = "https://mksoul-pro.com/showroom/csv/uriage_{file_basename}.xlsx"
+
+_LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS payout_history (
+    file_basename  TEXT NOT NULL,  -- ファイル名 (例 '350565_emily')
+    delivery_month TEXT NOT NULL,  -- 配信月 'YYYY/MM'
+    pay_month      TEXT,           -- 支払月 'YYYY/MM'
+    kind           TEXT,           -- 支払/繰越
+    source         TEXT NOT NULL,  -- workbook: 履歴Excelから取り込み / tool: このツールの支払実行で記録
+    updated_at     TEXT NOT NULL,
+    PRIMARY KEY (file_basename, delivery_month)
+);
+CREATE INDEX IF NOT EXISTS idx_payout_history_file ON payout_history (file_basename, delivery_month DESC);
+CREATE INDEX IF NOT EXISTS idx_payout_history_delivery ON payout_history (delivery_month);
+CREATE INDEX IF NOT EXISTS idx_payout_history_pay ON payout_history (pay_month, kind);
+CREATE TABLE IF NOT EXISTS workbook_versions (
+    file_basename TEXT PRIMARY KEY,
+    etag          TEXT,
+    last_modified TEXT,
+    row_count     INTEGER,
+    ingested_at   TEXT NOT NULL
+);
+"""
+
+# 支払月に対する繰越配信月: 「支払」行を起点に、より古い配信月へ連続する「繰越」行を、最初の「繰越」以外の行の手前まで
+_CARRYOVER_QUERY = """
+WITH base AS (
+    SELECT file_basename, MAX(delivery_month) AS base_month, MAX(source = 'tool') AS from_tool
+    FROM payout_history
+    WHERE pay_month = :pay_month AND kind = '支払' {file_filter}
+    GROUP BY file_basename
+),
+stop AS (
+    SELECT h.file_basename, MAX(h.delivery_month) AS stop_month
+    FROM payout_history h JOIN base b ON h.file_basename = b.file_basename
+    WHERE h.delivery_month < b.base_month AND COALESCE(h.kind, '') <> '繰越'
+    GROUP BY h.file_basename
+)
+SELECT h.file_basename, h.delivery_month, b.from_tool
+FROM payout_history h
+JOIN base b ON h.file_basename = b.file_basename
+LEFT JOIN stop s ON h.file_basename = s.file_basename
+WHERE h.delivery_month <= b.base_month AND h.delivery_month > COALESCE(s.stop_month, '')
+ORDER BY h.file_basename, h.delivery_month DESC
+"""
+
+
+class HistoryLedger:
+    """
+    履歴Excel (uriage_{ファイル名}.xlsx) の支払/繰越の記録を保持するローカルのSQLite台帳
+    - 履歴Excelは ETag / Last-Modified が変わったときだけ取り込み直す
+    - 支払月に対する全ライバーの繰越配信月を1回の問い合わせで返す
+    - 支払実行の結果をツール自身が記録し、同じ支払月の解決では履歴Excelが更新されていない (または取得できない) 限りそれを使う
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_LEDGER_SCHEMA)
+
+    @contextmanager
+    def _connection(self):
+        # スレッドごとに接続を分け、ブロックを抜けるときにコミット (例外時はロールバック) して閉じる
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def workbook_version(self, file_basename):
+        """取り込み済みの履歴Excelの ETag / Last-Modified を返す (未取り込みなら None)"""
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT etag, last_modified FROM workbook_versions WHERE file_basename = ?", (str(file_basename),)
+            ).fetchone()
+        return {'etag': row[0], 'last_modified': row[1]} if row else None
+
+    def replace_workbook_rows(self, file_basename, rows, etag=None, last_modified=None):
+        """
+        履歴Excelの内容で台帳を置き換える (履歴Excelの記録が、同じ配信月のツールの記録より優先される)
+        rows: [(配信月, 支払月, 支払/繰越)] 
+        """
+        file_basename = str(file_basename)
+        now = datetime.now(JST).isoformat()
+        with self._connection() as conn:
+            conn.execute("DELETE FROM payout_history WHERE file_basename = ? AND source = 'workbook'", (file_basename,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO payout_history VALUES (?, ?, ?, ?, 'workbook', ?)",
+                [(file_basename, delivery_month, pay_month, kind, now) for delivery_month, pay_month, kind in rows]
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO workbook_versions VALUES (?, ?, ?, ?, ?)",
+                (file_basename, etag, last_modified, len(rows), now)
+            )
+
+    def carryover_months(self, pay_month, file_basename=None):
+        """
+        支払月に対する繰越配信月を1回の問い合わせで解決する
+        戻り値: {ファイル名: {'months': ['YYYY/MM', ...] (最新 → 古い), 'from_tool': ツールの記録か}}
+        """
+        params = {'pay_month': str(pay_month)}
+        file_filter = ""
+        if file_basename is not None:
+            file_filter = "AND file_basename = :file_basename"
+            params['file_basename'] = str(file_basename)
+        resolved = {}
+        with self._connection() as conn:
+            for file_name, delivery_month, from_tool in conn.execute(_CARRYOVER_QUERY.format(file_filter=file_filter), params):
+                entry = resolved.setdefault(file_name, {'months': [], 'from_tool': bool(from_tool)})
+                entry['months'].append(delivery_month)
+        return resolved
+
+    def record_payout_run(self, pay_month, livers_months):
+        """
+        支払実行で解決した繰越月をツールの記録として書き込む
+        livers_months: {ファイル名: ['YYYY/MM', ...] (先頭が今回支払の配信月、以降が繰越分)}
+        """
+        now = datetime.now(JST).isoformat()
+        rows = []
+        for file_basename, months_list in livers_months.items():
+            if not months_list:
+                continue
+            rows.append((str(file_basename), months_list[0], str(pay_month), '支払', now))
+            for month_str in months_list[1:]:
+                info = get_month_info_by_slash(month_str)
+                rows.append((str(file_basename), month_str, info.pay_month if info else None, '繰越', now))
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO payout_history VALUES (?, ?, ?, ?, 'tool', ?)", rows
+            )
+        return len(rows)
+
+    def stats(self):
+        with self._connection() as conn:
+            counts = dict(conn.execute("SELECT source, COUNT(*) FROM payout_history GROUP BY source").fetchall())
+            n_workbooks = conn.execute("SELECT COUNT(*) FROM workbook_versions").fetchone()[0]
+        return {'取り込み済み履歴Excel': n_workbooks, '履歴Excelの行': counts.get('workbook', 0), 'ツールの記録': counts.get('tool', 0)}
+
+    def reset(self):
+        """台帳を空にする (次回の実行で全ての履歴Excelを取り込み直す)"""
+        with self._connection() as conn:
+            conn.execute("DELETE FROM payout_history")
+            conn.execute("DELETE FROM workbook_versions")
+
+
+@st.cache_resource
+def get_history_ledger():
+    """全セッションで共有する支払履歴台帳 (プロセスに1つ)"""
+    return HistoryLedger(HISTORY_LEDGER_PATH)
+
+
+def _normalize_history_month(val):
+    """配信月/支払月を 'YYYY/MM' 形式へ正規化する"""
+    # 既に 'YYYY/MM' の文字列なら整形して返す
+    if isinstance(val, str) and '/' in val:
+        parts = val.split('/')
+        if len(parts) >= 2:
+            y = parts[0].zfill(4)
+            m = parts[1].zfill(2)
+            return f"{y}/{m}"
+        return val
+    # datetime型やその他を pandas でパース
+    try:
+        dt = pd.to_datetime(val, errors='coerce')
+        if not pd.isna(dt):
+            return f"{dt.year}/{dt.month:02d}"
+    except Exception:
+        pass
+    return str(val).strip()
 
+
+def parse_history_workbook(df_hist):
+    """
+    履歴ExcelのDataFrameから台帳に取り込む行 [(配信月, 支払月, 支払/繰越)] を作る
+    同じ配信月の行が複数ある場合は上の行 (最新) を残す。必須列がなければ空リスト
+    """
     # 列名整形
-    df_hist.columns = df_hist.columns.str.strip()
+    df_hist.columns = df_hist.columns.astype(str).str.strip()
 
     # 必須列チェック
     expected = ['配信月', '支払月', '支払/繰越']
     if not all(col in df_hist.columns for col in expected):
         return []
 
-    # 配信月/支払月を 'YYYY/MM' 形式へ正規化する関数
-    def norm_month_to_yyyy_mm(val):
-        # 既に 'YYYY/MM' の文字列なら整形して返す
-        if isinstance(val, str) and '/' in val:
-            parts = val.split('/')
-            if len(parts) >= 2:
-                y = parts[0].zfill(4)
-                m = parts[1].zfill(2)
-                return f"{y}/{m}"
-            return val
-        # datetime型やその他を pandas でパース
-        try:
-            dt = _pd.to_datetime(val, errors='coerce')
-            if not _pd.isna(dt):
-                return f"{dt.year}/{dt.month:02d}"
-        except Exception:
-            pass
-        return str(val).strip()
+    df = pd.DataFrame({
+        '配信月': df_hist['配信月'].apply(_normalize_history_month),
+        '支払月': df_hist['支払月'].apply(_normalize_history_month),
+        '支払/繰越': df_hist['支払/繰越'].astype(str).str.strip(),
+    }).drop_duplicates(subset=['配信月'], keep='first')
+    return list(df.itertuples(index=False, name=None))
 
-    df_hist['配信月'] = df_hist['配信月'].apply(norm_month_to_yyyy_mm)
-    df_hist['支払月'] = df_hist['支払月'].apply(norm_month_to_yyyy_mm)
-    df_hist['支払/繰越'] = df_hist['支払/繰越'].astype(str).str.strip()
 
-    # 履歴は上が最新（想定）か下が最新か不明なので、最新が上に来るよう一意な配信月で先頭保持
-    uniq = df_hist.drop_duplicates(subset=['配信月'], keep='first').reset_index(drop=True)
+def sync_workbook_into_ledger(ledger, file_basename, raise_on_error=False, deadline=None):
+    """
+    履歴Excelを条件付きで取得し (前回の ETag / Last-Modified を送る)、更新されていれば台帳に取り込み直す
+    取得は WORKBOOK_FETCH_POLICY (タイムアウト・再試行・ヘッジ) に従い、deadline を過ぎたら打ち切る
+    戻り値: 'ingested' (取り込み) / 'not_modified' (未更新) / 'failed' (取得・解析の失敗)
+    raise_on_error=True の場合、履歴Excelが存在しない等 (401/403/429 以外の 4xx) は PermanentFetchError を送出する
+    """
+    url_xlsx = HISTORY_WORKBOOK_URL.format(file_basename=file_basename)
+    version = ledger.workbook_version(file_basename)
+    headers = {}
+    if version and version['etag']:
+        headers['If-None-Match'] = version['etag']
+    if version and version['last_modified']:
+        headers['If-Modified-Since'] = version['last_modified']
+
+    def attempt(timeout, cancel):
+        # 上限付きの再利用バッファへストリーミング取得し、本文はバイト列として返してバッファはすぐに解放する
+        response_info = {}
+        buf, _ = download_to_buffer(requests, url_xlsx, MAX_XLSX_BYTES, response_info=response_info, cancel=cancel, headers=headers, timeout=timeout)
+        if buf is None:
+            return None, response_info
+        try:
+            return buf.getvalue(), response_info
+        finally:
+            release_download_buffer()
 
-    # target_payment_month_str（例 '2025/12'）に該当する '支払' の行を探す
-    mask = (uniq['支払月'] == target_payment_month_str) & (uniq['支払/繰越'] == '支払')
-    idxs = uniq.index[mask].tolist()
-    if not idxs:
-        return []
+    try:
+        raw_bytes, response_info = call_with_policy(WORKBOOK_FETCH_POLICY, attempt, deadline, label=f"履歴Excel ({file_basename})")
+        if raw_bytes is None:
+            return 'not_modified'
+        df_hist = pd.read_excel(io.BytesIO(raw_bytes))
+    except requests.exceptions.HTTPError as e:
+        status = e.response.status_code if e.response is not None else None
+        if raise_on_error and status is not None and 400 <= status < 500 and status not in (401, 403, 429):
+            raise PermanentFetchError(f"HTTP {status} (履歴Excel {file_basename})") from e
+        if raise_on_error:
+            raise
+        return 'failed'
+    except ResponseTooLargeError as e:
+        logging.warning(f"履歴Excelのサイズが上限を超えたためスキップしました: {e}")
+        if raise_on_error:
+            raise
+        return 'failed'
+    except Exception:
+        if raise_on_error:
+            raise
+        # Excel取得/解析に失敗したら未解決のまま返す（PDF対応は必要なら別途実装）
+        return 'failed'
+
+    response_headers = response_info.get('headers', {})
+    ledger.replace_workbook_rows(
+        file_basename, parse_history_workbook(df_hist), response_headers.get('ETag'), response_headers.get('Last-Modified')
+    )
+    return 'ingested'
 
-    base_idx = idxs[0]
-    result = []
-    result.append(uniq.loc[base_idx, '配信月'])  # 最新（今回支払対象の配信月）
-
-    # base_idx の次（より古い行）から連続して '繰越' を追加、途中で '支払' が出たら終了
-    i = base_idx + 1
-    while i < len(uniq):
-        kind = str(uniq.loc[i, '支払/繰越']).strip()
-        if kind == '繰越':
-            result.append(uniq.loc[i, '配信月'])
-            i += 1
-            continue
-        else:
-            break
 
-    return result
+def resolve_carryover_with_ledger(checkpoint, file_basenames, pay_month, deadline=None):
+    """
+    チェックポイントで未解決のライバーについて、履歴Excelを台帳へ並列に同期 (更新分のみ取得) し、
+    支払月に対する全ライバーの繰越配信月を1回の問い合わせで解決してチェックポイントに保存する
+    ツール自身が記録した支払行があるライバーも更新を確認し (未更新なら 304 のみ)、更新された履歴Excelを優先する
+    同期に失敗したライバーは、ツールの記録があればそれを使い、なければ未解決のまま残してライバーごとの処理で再試行・失敗記録を行う
+    戻り値: 同期結果の件数 (Counter)
+    """
+    ledger = get_history_ledger()
+    pending = [str(f) for f in dict.fromkeys(file_basenames) if f and not pd.isna(f) and checkpoint.get_liver(f) is None]
+
+    def sync_shared(file_basename):
+        # 同じ履歴Excelの同期は (複数アカウントの同時実行でも) 1回にまとめる。失敗は共有キャッシュに残さない
+        status, _ = get_shared_fetch_cache().get_or_compute(
+            ("ledger_sync", file_basename),
+            lambda: (lambda result: None if result == 'failed' else result)(sync_workbook_into_ledger(ledger, file_basename, deadline=deadline))
+        )
+        return status or 'failed'
+
+    statuses = {}
+    if pending:
+        with ThreadPoolExecutor(max_workers=LEDGER_SYNC_WORKERS, thread_name_prefix="ledger-sync") as executor:
+            statuses = dict(zip(pending, executor.map(sync_shared, pending)))
+    resolved = ledger.carryover_months(pay_month)
+
+    for file_basename in pending:
+        entry = resolved.get(file_basename, {})
+        if statuses[file_basename] != 'ingested' and entry.get('from_tool'):
+            statuses[file_basename] = 'tool'
+        if statuses[file_basename] == 'failed':
+            continue
+        checkpoint.save_liver(file_basename, entry.get('months', []))
+    return Counter(statuses.values())
 
 
 
@@ -602,7 +3211,16 @@ def main():
     st.markdown("<p style='text-align: left;'>⚠️ <b>注意</b>: このツールは、<b>Secretsに設定されたCookieが有効な間のみ</b>動作します。</p>", unsafe_allow_html=True)
     st.markdown("<p style='text-align: left;'>⚠️ <b>注意</b>: <b>処理対象ライバーファイル（ https://mksoul-pro.com/showroom/file/shiharai-taishou.csv ）の内容が適切か確認してください</b>。</p>", unsafe_allow_html=True)
     st.markdown("---")
-    
+
+    with st.sidebar.expander("📒 支払履歴台帳"):
+        ledger = get_history_ledger()
+        st.json(ledger.stats())
+        st.caption("履歴Excelは更新されたものだけを取り込みます。支払実行後の記録は、同じ支払月の再実行で履歴Excelが更新されていなければ使われます。")
+        if st.button("台帳を空にして履歴Excelから取り込み直す", key='reset_ledger'):
+            ledger.reset()
+            get_shared_fetch_cache().clear()
+            st.success("台帳を空にしました。次回の実行で全ての履歴Excelを取り込み直します。")
+
     # セッションステートの初期化
     if 'df_room_sales' not in st.session_state:
         st.session_state['df_room_sales'] = pd.DataFrame()
@@ -629,8 +3247,8 @@ def main():
         key='month_selector' # keyを追加し、選択を追跡
     )
     
-    selected_data = next(((ts, ym) for label, ts, ym in month_options_tuple if label == selected_label), (None, None))
-    selected_timestamp = selected_data[0]
+    selected_info = get_month_info_by_label(selected_label)
+    selected_timestamp = selected_info.timestamp if selected_info else None
     
     if selected_timestamp is None:
         st.warning("有効な月が選択されていません。")
@@ -644,36 +3262,94 @@ def main():
     # 2. 実行ボタン (処理の流れ ②)
     st.markdown("#### 2. データ取得と抽出の実行")
     
-    if st.button("🚀 データの取得・抽出を実行", type="primary"):
-        st.markdown("---")
-        
-        # 処理対象ライバーファイルの読み込み (処理の流れ ③)
-        df_livers = load_target_livers(TARGET_LIVER_FILE_URL)
-        st.session_state['df_livers'] = df_livers # セッションステートに保存
-        
-        if df_livers.empty:
-            st.error("処理対象ライバーファイルが読み込めなかったため、処理を中断します。")
+    discard_checkpoint = st.checkbox(
+        "前回の途中結果（チェックポイント）を破棄して最初から実行する",
+        value=False,
+        help="Cookie更新後に再実行すると、前回中断した地点から再開します。"
+    )
+    offline_mode = st.checkbox(
+        "🗄️ オフライン再処理モード（アーカイブ済みHTMLから再計算し、SHOWROOMへは接続しない）",
+        value=False,
+        help="抽出ロジックの修正後やページ構造変更の確認時に、過去に取得した生HTMLから抽出・ランク判定・支払額計算をやり直します。"
+    )
+
+    # 複数のオーガナイザーアカウントが設定されている場合は、処理するアカウントを選択する
+    multi_account_config = len(ORGANIZER_ACCOUNTS) > 1
+    if multi_account_config:
+        all_account_names = [account.name for account in ORGANIZER_ACCOUNTS]
+        selected_account_names = st.multiselect(
+            "処理するオーガナイザーアカウント",
+            options=all_account_names,
+            default=all_account_names,
+            help="複数選択すると、アカウントごとに並列で取得し、MK全体分配額・MKランクもアカウントごとに判定します。"
+        )
+        selected_accounts = [account for account in ORGANIZER_ACCOUNTS if account.name in selected_account_names]
+        if not selected_accounts:
+            st.warning("処理するアカウントを1つ以上選択してください。")
             return
-            
-        with st.spinner(f"処理中: {selected_label}の売上データをSHOWROOMから取得しています..."):
-            
-            # --- SHOWROOM売上データの取得 (処理の流れ ④) ---
-            
-            # ルーム売上
-            get_and_extract_sales_data("room_sales", selected_timestamp, AUTH_COOKIE_STRING)
+    else:
+        selected_accounts = ORGANIZER_ACCOUNTS
 
-            # プレミアムライブ売上
-            get_and_extract_sales_data("premium_live", selected_timestamp, AUTH_COOKIE_STRING)
+    # 取得・抽出はバックグラウンドのジョブとして実行し、UIはその進捗を表示する
+    runner = get_job_runner()
+    account_fingerprints = "+".join(cookie_fingerprint(account.cookie_string) for account in selected_accounts)
+    job_key = f"{selected_info.ym}{'_offline' if offline_mode else ''}:{account_fingerprints}"
+    job_label = f"{selected_label}{' (オフライン再処理)' if offline_mode else ''}"
+    if multi_account_config:
+        job_label += f" [{', '.join(account.name for account in selected_accounts)}]"
 
-            # タイムチャージ売上
-            get_and_extract_sales_data("time_charge", selected_timestamp, AUTH_COOKIE_STRING) 
-        
-        st.balloons()
-        st.success("🎉 **売上データの取得とセッションステートへの格納が完了しました！**")
+    if st.button("🚀 データの取得・抽出を実行", type="primary"):
+        if len(selected_accounts) > 1:
+            job = runner.submit(
+                job_key,
+                job_label,
+                run_multi_account_pipeline,
+                selected_info,
+                selected_accounts,
+                offline_mode=offline_mode,
+                discard_checkpoint=discard_checkpoint,
+            )
+        else:
+            account = selected_accounts[0]
+            job = runner.submit(
+                job_key,
+                job_label,
+                run_fetch_pipeline,
+                selected_info,
+                account.cookie_string,
+                account.login_id,
+                offline_mode=offline_mode,
+                discard_checkpoint=discard_checkpoint,
+                account_name=account.name if multi_account_config else None,
+            )
+        st.session_state['job_id'] = job.job_id
+
+    # このセッションで投入したジョブ、なければ同じ対象について他のセッションが実行したジョブを表示する
+    job = runner.get(st.session_state.get('job_id'))
+    if job is None or job.job_key != job_key:
+        job = runner.latest(job_key)
+
+    if job is not None:
+        st.markdown("---")
+        render_job_status(job)
+        if job.status == 'done' and st.session_state.get('loaded_job_id') != job.job_id:
+            load_job_result_into_session(job)
+            st.balloons()
+
+    with st.sidebar.expander("📋 ジョブ一覧"):
+        all_jobs = runner.jobs()
+        if all_jobs:
+            st.dataframe(pd.DataFrame([j.snapshot() for j in reversed(all_jobs)]), hide_index=True)
+        else:
+            st.caption("実行されたジョブはありません。")
 
     # --- 取得・抽出結果の表示 ---
     
-    if not st.session_state.df_room_sales.empty or 'df_livers' in st.session_state:
+    result_month_label = st.session_state.get('result_month_label')
+    if result_month_label is not None and result_month_label != selected_label:
+        # 表示中の結果は別の配信月のもの。月を切り替えても再計算はせず、新しいジョブとして取得・抽出する
+        st.info(f"**{selected_label}** の実行結果はまだありません (表示中の結果は {result_month_label})。実行ボタンを押すと、新しいジョブとして取得・抽出します。")
+    elif not st.session_state.df_room_sales.empty or 'df_livers' in st.session_state:
 
         st.markdown("## 3. 抽出結果の確認、ランク・支払額の付与") # タイトルを修正
         st.markdown("---")
@@ -687,7 +3363,7 @@ def main():
             display_cols = [col for col in expected_cols if col in df_livers.columns]
             
             # 「インボイス」列は、入力データそのものとして保持し、計算に使われる 'is_invoice_registered' (純粋なbool) と比較可能とする
-            st.dataframe(df_livers[display_cols], height=150)
+            render_paged_dataframe(df_livers[display_cols], key='view_livers', height=150)
             
             # --- 売上データを結合して抽出 ---
             
@@ -700,309 +3376,61 @@ def main():
             
             if not all_sales_data.empty:
                 st.subheader("全売上データ (取得元) - 合計")
-                st.dataframe(all_sales_data, height=150)
-                
-                # ルームIDをキーに処理対象ライバーと結合
-                df_merged = pd.merge(
-                    df_livers,
-                    all_sales_data,
-                    on='ルームID',
-                    how='left'
-                )
-
-                # 売上データがないライバー（NULL行）の分配額を0として処理
-                df_merged['分配額'] = df_merged['分配額'].fillna(0).astype(int)
-                
-                # 表示用に、売上がゼロの行のデータ種別をNaNから「売上なし」などに変換
-                df_merged['データ種別'] = df_merged['データ種別'].fillna('売上データなし')
-                
-                # 配信月とアカウントIDを追加
-                df_merged['配信月'] = st.session_state.selected_month_label
-                # アカウントIDを埋める
-                df_merged['アカウントID'] = df_merged.apply(
-                    lambda row: row['アカウントID'] if pd.notna(row['アカウントID']) else st.session_state.login_account_id if row['ルームID'] == 'MKsoul' else np.nan, axis=1
-                )
-                
-                # ★★★ 修正点3: マージ直後にis_invoice_registered列を明示的にbool型に再キャストする (二重の防御) ★★★
-                if 'is_invoice_registered' in df_merged.columns:
-                    df_merged['is_invoice_registered'] = df_merged['is_invoice_registered'].astype(bool)
-
-
-                # 🌟 ルーム売上のみにランク情報を付与 🌟
-                # df_mergedを「ルーム売上」データと「その他」データに分割
-                df_room_sales_only = df_merged[df_merged['データ種別'] == 'ルーム売上'].copy()
-                df_other_sales = df_merged[df_merged['データ種別'] != 'ルーム売上'].copy()
-                
+                render_paged_dataframe(all_sales_data, key='view_all_sales', height=150)
                 
-                if not df_room_sales_only.empty:
-                    
-                    # 1. MKランク（全体ランク）の決定
-                    df_raw_room_sales = st.session_state.df_room_sales
-                    
-                    try:
-                        mk_sales_total = df_raw_room_sales[df_raw_room_sales['ルームID'] == 'MKsoul']['分配額'].iloc[0].item() 
-                        if mk_sales_total == 0:
-                            st.warning("⚠️ MK全体分配額が0です。SHOWROOM側のデータがないか、合計金額の抽出に失敗している可能性があります。")
-                    except IndexError:
-                        mk_sales_total = 0
-                        st.error("🚨 重大なエラー: 合計売上を示す 'MKsoul' 行がデータ取得元から見つかりませんでした。")
-                    except Exception as e:
-                        mk_sales_total = 0
-                        st.error(f"🚨 重大なエラー: 合計売上計算中に予期せぬエラーが発生しました: {e}")
-                    
-                    mk_rank_value = get_mk_rank(mk_sales_total)
-                    st.info(f"🔑 **MK全体分配額**: {mk_sales_total:,}円 (→ **MKランク: {mk_rank_value}**)")
-                    
-                    # MKランク、個別ランクの設定
-                    df_room_sales_only['MKランク'] = mk_rank_value
-                    df_room_sales_only['個別ランク'] = df_room_sales_only['分配額'].apply(get_individual_rank)
-                    
-                    # 適用料率の生成
-                    df_room_sales_only['適用料率'] = np.where(
-                        df_room_sales_only['ルームID'] == 'MKsoul',
-                        '-',
-                        '適用料率：' + df_room_sales_only['MKランク'].astype(str) + df_room_sales_only['個別ランク']
-                    )
-                    
-                    # 4. ルーム売上支払額の計算
-                    df_room_sales_only['支払額'] = np.where(
-                        df_room_sales_only['ルームID'] == 'MKsoul',
-                        np.nan, # MKsoul行は支払額なし
-                        df_room_sales_only.apply(
-                            lambda row: calculate_payment_estimate(
-                                row['個別ランク'], 
-                                row['MKランク'], 
-                                row['分配額'],
-                                row['is_invoice_registered'] # 厳格チェック付きの関数に渡す
-                            ), axis=1)
-                    )
-                    
+                # 抽出結果はジョブごとにキャッシュし、表示の操作 (ページ送り・絞り込み) では再計算しない
+                # (抽出・支払額計算はジョブの中で行い、画面側では同期的に再計算しない)
+                result_key = (st.session_state.get('run_key'), st.session_state.get('run_token'))
+                cached_result = st.session_state.get('extracted_cache')
+                if cached_result is None or cached_result['key'] != result_key:
+                    st.info("この実行の抽出結果がありません。実行ボタンを押して、取得・抽出をやり直してください。")
                 else:
-                    st.warning("ルーム売上データ（「ルーム売上」データ種別）が存在しないため、ランク判定・支払額計算はスキップしました。")
-                    mk_sales_total = 0 
-                    mk_rank_value = get_mk_rank(mk_sales_total) 
-                    st.info(f"🔑 **MK全体分配額**: 0円 (→ **MKランク: {mk_rank_value}**)")
-
-                    df_room_sales_only['MKランク'] = np.nan
-                    df_room_sales_only['個別ランク'] = np.nan
-                    df_room_sales_only['適用料率'] = '-'
-                    df_room_sales_only['支払額'] = np.nan
+                    df_extracted = cached_result['df']
+                    df_summary = cached_result['summary']
+                    st.caption("💾 キャッシュ済みの抽出結果を表示しています。最新のデータを取得するには実行ボタンを押してください。")
 
+                    st.subheader("✅ 抽出・結合された最終データ (支払額計算済み)")
+                    st.info(f"このデータで、分配額から**支払額**の計算が完了しました。合計 {len(df_livers)}件のライバー情報に対して、{len(df_extracted)}件の売上明細行が紐付けられました。")
+                    render_paged_dataframe(df_extracted, key='view_extracted')
                 
-                # 5. その他の売上行のランク列を埋める
-                df_other_sales['MKランク'] = '-'
-                df_other_sales['個別ランク'] = '-'
-                df_other_sales['適用料率'] = '-'
-
-                # 6. その他の売上支払額の計算
-                df_other_sales['支払額'] = np.nan # 初期化
-
-                # プレミアムライブ売上
-                premium_live_mask = df_other_sales['データ種別'] == 'プレミアムライブ売上'
-                if premium_live_mask.any():
-                    df_other_sales.loc[premium_live_mask, '支払額'] = df_other_sales[premium_live_mask].apply(
-                        lambda row: calculate_paid_live_payment_estimate(
-                            row['分配額'],
-                            row['is_invoice_registered'] # 厳格チェック付きの関数に渡す
-                        ), axis=1
-                    )
-
-                # タイムチャージ売上
-                time_charge_mask = df_other_sales['データ種別'] == 'タイムチャージ売上'
-                if time_charge_mask.any():
-                    df_other_sales.loc[time_charge_mask, '支払額'] = df_other_sales[time_charge_mask].apply(
-                        lambda row: calculate_time_charge_payment_estimate(
-                            row['分配額'],
-                            row['is_invoice_registered'] # 厳格チェック付きの関数に渡す
-                        ), axis=1
-                    )
-                
-                # 売上データがない行の支払額は0
-                no_sales_mask = df_other_sales['データ種別'] == '売上データなし'
-                df_other_sales.loc[no_sales_mask, '支払額'] = 0
-
-                # 7. 最終的なDataFrameを再結合
-                df_extracted = pd.concat([df_room_sales_only, df_other_sales], ignore_index=True)
-
+                    # 計算ステップのためにセッションステートに保持
+                    st.session_state['df_extracted'] = df_extracted
 
-                # --- 繰越追加処理（ここから） ---
-                # 各ライバーの履歴ファイルを参照して、連続する繰越配信月分を取得し
-                # 同じ単月処理と同等の行を作成して df_extracted に追加する
-
-                # selected_month_label 例: '2025年10月分' -> 支払月 = 選択配信月 + 2ヶ月 -> 'YYYY/MM'
-                sel_label = st.session_state.get('selected_month_label', '')
-                m = re.match(r'(\d{4})年(\d{2})月分', str(sel_label))
-                if m:
-                    sel_year = int(m.group(1)); sel_month = int(m.group(2))
-                else:
-                    sel_year = None; sel_month = None
-
-                if sel_year and sel_month:
-                    # 支払月 = 選択された配信月 + 2ヶ月
-                    pay_year = sel_year
-                    pay_month = sel_month + 2
-                    if pay_month > 12:
-                        pay_month -= 12
-                        pay_year += 1
-                    pay_month_str = f"{pay_year}/{pay_month:02d}"  # 履歴Excelの '支払月' と照合する形式
-
-                    # df_livers は既にロード済み
-                    if 'df_livers' in locals() or 'df_livers' in globals() or 'df_livers' in st.session_state:
-                        df_livers_local = st.session_state.get('df_livers', pd.DataFrame()).copy()
-                        if not df_livers_local.empty:
-                            # 1ライバーずつ処理
-                            for _, liver_row in df_livers_local.iterrows():
-                                file_basename = liver_row.get('ファイル名')
-                                room_id = str(liver_row.get('ルームID', '')).strip()
-                                if not file_basename or pd.isna(file_basename):
-                                    continue
-
-                                try:
-                                    months_list = get_kurikoshi_months_from_excel(str(file_basename), pay_month_str)
-                                except Exception:
-                                    months_list = []
-
-                                # months_list の先頭は今回処理済みの配信月（既に df_extracted に含まれている）
-                                if len(months_list) <= 1:
-                                    continue
-                                months_to_add = months_list[1:]  # 例 ['2025/09','2025/08',...]
-
-                                for mstr in months_to_add:
-                                    # mstr は 'YYYY/MM' 形式
-                                    try:
-                                        y_s, mm_s = mstr.split('/')
-                                        y_i = int(y_s); m_i = int(mm_s)
-                                        # タイムスタンプに変換（fetch_and_process_data が受けるタイムスタンプ）
-                                        dt_naive = datetime(y_i, m_i, 1, 0, 0, 0)
-                                        dt_obj_jst = JST.localize(dt_naive, is_dst=None)
-                                        ts = int(dt_obj_jst.timestamp())
-                                    except Exception:
-                                        continue
-
-                                    # その月に関する SHOWROOM の3種データを取得（既存関数を再利用）
-                                    df_room_month = fetch_and_process_data(ts, AUTH_COOKIE_STRING, SR_ROOM_SALES_URL, "room_sales")
-                                    df_premium_month = fetch_and_process_data(ts, AUTH_COOKIE_STRING, SR_PREMIUM_LIVE_URL, "premium_live")
-                                    df_time_month = fetch_and_process_data(ts, AUTH_COOKIE_STRING, SR_TIME_CHARGE_URL, "time_charge")
-
-                                    # 取得失敗や None の場合はスキップ
-                                    if df_room_month is None or df_premium_month is None or df_time_month is None:
-                                        continue
-
-                                    # MK全体合計は df_room_month の MKsoul 行から取得（既存ロジックに合わせる）
-                                    try:
-                                        mk_total = int(df_room_month[df_room_month['ルームID'] == 'MKsoul']['分配額'].iloc[0])
-                                    except Exception:
-                                        mk_total = 0
-                                    mk_rank_value = get_mk_rank(mk_total)
-
-                                    # 対象ライバーの行だけ抽出
-                                    all_sales_month = pd.concat([df_room_month, df_premium_month, df_time_month], ignore_index=True)
-                                    sel_rows = all_sales_month[all_sales_month['ルームID'] == room_id].copy()
-
-                                    if sel_rows.empty:
-                                        # 売上データなしの行を既存の形式に合わせて作る
-                                        no_row = {
-                                            'ルームID': room_id,
-                                            '分配額': 0,
-                                            'アカウントID': np.nan,
-                                            'データ種別': '売上データなし',
-                                            '配信月': f"{y_i}年{m_i:02d}月分",
-                                            'is_invoice_registered': bool(liver_row.get('is_invoice_registered', False))
-                                        }
-                                        df_add = pd.DataFrame([no_row])
-                                    else:
-                                        sel_rows['配信月'] = f"{y_i}年{m_i:02d}月分"
-                                        sel_rows['is_invoice_registered'] = bool(liver_row.get('is_invoice_registered', False))
-
-                                        # ルーム売上は個別ランク・MKランク・支払額を付与
-                                        df_room_part = sel_rows[sel_rows['データ種別'] == 'ルーム売上'].copy()
-                                        df_other_part = sel_rows[sel_rows['データ種別'] != 'ルーム売上'].copy()
-
-                                        if not df_room_part.empty:
-                                            df_room_part['MKランク'] = mk_rank_value
-                                            df_room_part['個別ランク'] = df_room_part['分配額'].apply(get_individual_rank)
-                                            df_room_part['適用料率'] = np.where(
-                                                df_room_part['ルームID'] == 'MKsoul',
-                                                '-',
-                                                '適用料率：' + df_room_part['MKランク'].astype(str) + df_room_part['個別ランク']
-                                            )
-                                            df_room_part['支払額'] = df_room_part.apply(
-                                                lambda row: calculate_payment_estimate(
-                                                    row['個別ランク'],
-                                                    row['MKランク'],
-                                                    row['分配額'],
-                                                    row['is_invoice_registered']
-                                                ), axis=1
-                                            )
-                                        else:
-                                            df_room_part = pd.DataFrame(columns=sel_rows.columns.tolist() + ['MKランク','個別ランク','適用料率','支払額'])
-
-                                        # その他（プレミアム/タイムチャージ）
-                                        if not df_other_part.empty:
-                                            df_other_part['MKランク'] = '-'
-                                            df_other_part['個別ランク'] = '-'
-                                            df_other_part['適用料率'] = '-'
-                                            mask_pre = df_other_part['データ種別'] == 'プレミアムライブ売上'
-                                            if mask_pre.any():
-                                                df_other_part.loc[mask_pre, '支払額'] = df_other_part[mask_pre].apply(
-                                                    lambda r: calculate_paid_live_payment_estimate(r['分配額'], r.get('is_invoice_registered', False)), axis=1
-                                                )
-                                            mask_time = df_other_part['データ種別'] == 'タイムチャージ売上'
-                                            if mask_time.any():
-                                                df_other_part.loc[mask_time, '支払額'] = df_other_part[mask_time].apply(
-                                                    lambda r: calculate_time_charge_payment_estimate(r['分配額'], r.get('is_invoice_registered', False)), axis=1
-                                                )
-                                        else:
-                                            df_other_part = pd.DataFrame(columns=sel_rows.columns.tolist() + ['MKランク','個別ランク','適用料率','支払額'])
-
-                                        df_add = pd.concat([df_room_part, df_other_part], ignore_index=True)
-
-                                    # 最終形式に沿って列を揃え、支払額の型を整える
-                                    cols_to_keep = [c for c in ['ルームID','ファイル名','インボイス','is_invoice_registered','データ種別','分配額','個別ランク','MKランク','適用料率','支払額','アカウントID','配信月'] if c in df_add.columns]
-                                    df_add = df_add[cols_to_keep]
-                                    if '支払額' in df_add.columns:
-                                        df_add['支払額'] = df_add['支払額'].replace(['#ERROR_CALC','#ERROR_MK','#ERROR_RANK','#N/A'], np.nan)
-                                        df_add['支払額'] = pd.to_numeric(df_add['支払額'], errors='coerce').fillna(0).astype('Int64')
-
-                                    # df_extracted に連結（既存の順序を崩さない）
-                                    df_extracted = pd.concat([df_extracted, df_add], ignore_index=True)
-
-                # --- 繰越追加処理（ここまで） ---
-
-
-                
-                # 8. 不要な列を整理し、抽出が完了したDataFrameを表示 (ランク情報を追加)
-                final_display_cols = ['ルームID']
-                if 'ファイル名' in df_livers.columns:
-                    final_display_cols.append('ファイル名')
-                if 'インボイス' in df_livers.columns:
-                    final_display_cols.append('インボイス')
-                
-                # is_invoice_registered列は、計算に使われた「真のブール値」を示すため、表示列に残します
-                final_display_cols.extend(['is_invoice_registered', 'データ種別', '分配額', '個別ランク', 'MKランク', '適用料率', '支払額', 'アカウントID', '配信月'])
-                
-                # DataFrameに存在しない列を除外
-                df_extracted_cols = [col for col in final_display_cols if col in df_extracted.columns]
-                df_extracted = df_extracted[df_extracted_cols]
-                
-                # 支払額列の表示形式を調整（整数としてNaN以外を扱う）
-                df_extracted['支払額'] = df_extracted['支払額'].replace(['#ERROR_CALC', '#ERROR_MK', '#ERROR_RANK', '#N/A'], np.nan)
-                df_extracted['支払額'] = pd.to_numeric(df_extracted['支払額'], errors='coerce').fillna(0).astype('Int64') # Int64でNaNを許容する整数型に
-
-                # ソートして見やすくする（オプション）
-                df_extracted = df_extracted.sort_values(by=['ルームID', 'データ種別'], ascending=[True, False]).reset_index(drop=True)
-
-                st.subheader("✅ 抽出・結合された最終データ (支払額計算済み)")
-                st.info(f"このデータで、分配額から**支払額**の計算が完了しました。合計 {len(df_livers)}件のライバー情報に対して、{len(df_extracted)}件の売上明細行が紐付けられました。")
-                st.dataframe(df_extracted)
-                
-                # 計算ステップのためにセッションステートに保持
-                st.session_state['df_extracted'] = df_extracted
+                    # 複数アカウントの場合は、アカウントごとのMK全体分配額・MKランクを一覧表示する
+                    df_raw_room_sales = st.session_state.df_room_sales
+                    if ROSTER_ACCOUNT_COLUMN in df_raw_room_sales.columns:
+                        df_mk = df_raw_room_sales.loc[
+                            df_raw_room_sales['ルームID'] == 'MKsoul', [ROSTER_ACCOUNT_COLUMN, 'アカウントID', '分配額']
+                        ].rename(columns={'分配額': 'MK全体分配額'})
+                        df_mk['MKランク'] = df_mk['MK全体分配額'].apply(get_mk_rank)
+                        st.subheader("🔑 アカウント別 MK全体分配額")
+                        st.dataframe(df_mk, hide_index=True)
+
+                    st.subheader("📊 ライバー別 支払サマリー")
+                    st.info(f"{len(df_summary)}名のライバーについて、データ種別・配信月ごとの支払額合計と繰越分の合計を集計しました。")
+                    render_paged_dataframe(df_summary, key='view_summary')
+                    st.session_state['df_summary'] = df_summary
+
+                    st.subheader("🔍 前回実行との差分")
+                    df_diff = st.session_state.get('df_diff')
+                    if df_diff is None:
+                        st.info("前回の実行結果がないため、差分はありません。次回の実行から、追加・削除・変更された行のみを表示します。")
+                    elif df_diff.empty:
+                        st.success("前回の実行結果から変更はありません。")
+                    else:
+                        counts = df_diff['変更種別'].value_counts()
+                        st.info(f"追加 **{counts.get('追加', 0)}件** / 削除 **{counts.get('削除', 0)}件** / 変更 **{counts.get('変更', 0)}件** (支払額差の合計: {int(df_diff['支払額差'].sum()):,}円)")
+                        render_paged_dataframe(df_diff, key='view_diff')
             
             else:
                 st.warning("結合対象の売上データがありません。")
         else:
             st.info("実行ボタンを押して、処理対象ライバーファイルの読み込みと売上データの取得を行ってください。")
 
+    # 実行中のジョブがあれば、一定間隔で再描画して進捗を更新する
+    if job is not None and job.is_active:
+        time.sleep(JOB_POLL_INTERVAL_SECONDS)
+        st.rerun()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
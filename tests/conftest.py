@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# streamlit_app は読み込み時に st.secrets を参照するため、テスト用の secrets.toml を置いたディレクトリで読み込む
+_SECRETS_DIR = tempfile.mkdtemp(prefix="streamlit_app_tests_")
+os.makedirs(os.path.join(_SECRETS_DIR, ".streamlit"))
+with open(os.path.join(_SECRETS_DIR, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+    f.write('[showroom]\nauth_cookie_string = "test=dummy"\nlogin_id = "test"\n')
+os.chdir(_SECRETS_DIR)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
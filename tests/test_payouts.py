@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from streamlit_app import (
+    MK_RANK_RATE_KEY,
+    PAID_LIVE_RATE_BP,
+    RANK_RATE_BP,
+    RATE_BP_SCALE,
+    TAX_DENOMINATOR,
+    TAX_NUMERATOR_REGISTERED,
+    TAX_NUMERATOR_UNREGISTERED,
+    TIME_CHARGE_RATE_BP,
+    calculate_paid_live_payment_estimate,
+    calculate_payment_estimate,
+    calculate_time_charge_payment_estimate,
+    fixed_point_payout,
+    vectorized_payouts,
+)
+
+
+# --- 整数化以前の計算式 (浮動小数点 + round) ---
+
+def baseline_payout(amount, rate, is_registered):
+    """従来の calculate_* と同じ式: (分配額 × 1.10 または 1.08 × rate) / 1.10 を round で丸める"""
+    individual_revenue = float(amount)
+    if is_registered:
+        payment_estimate = (individual_revenue * 1.10 * rate) / 1.10
+    else:
+        payment_estimate = (individual_revenue * 1.08 * rate) / 1.10
+    return round(payment_estimate)
+
+
+BASELINE_RANK_RATES = {
+    'D': {1: 0.750, 3: 0.755, 5: 0.760, 7: 0.765, 9: 0.770, 11: 0.775},
+    'E': {1: 0.725, 3: 0.730, 5: 0.735, 7: 0.740, 9: 0.745, 11: 0.750},
+    'C': {1: 0.775, 3: 0.780, 5: 0.785, 7: 0.790, 9: 0.795, 11: 0.800},
+    'B': {1: 0.800, 3: 0.805, 5: 0.810, 7: 0.815, 9: 0.820, 11: 0.825},
+    'A': {1: 0.825, 3: 0.830, 5: 0.835, 7: 0.840, 9: 0.845, 11: 0.850},
+    'S': {1: 0.850, 3: 0.855, 5: 0.860, 7: 0.865, 9: 0.870, 11: 0.875},
+    'SS': {1: 0.875, 3: 0.880, 5: 0.885, 7: 0.890, 9: 0.895, 11: 0.900},
+    'SSS': {1: 0.900, 3: 0.905, 5: 0.910, 7: 0.915, 9: 0.920, 11: 0.925},
+}
+
+RATE_CASES = [(RANK_RATE_BP[rank][key], rate) for rank, by_key in BASELINE_RANK_RATES.items() for key, rate in by_key.items()]
+RATE_CASES += [(PAID_LIVE_RATE_BP, 0.9), (TIME_CHARGE_RATE_BP, 1.00)]
+
+AMOUNTS = list(range(0, 3000)) + [12_345, 99_999, 1_000_001, 7_654_321]
+
+
+def is_half_tie(amount, rate_bp, is_registered):
+    """厳密な支払額がちょうど .5 になる (丸め方式で結果が変わる) 分配額か"""
+    tax_numerator = TAX_NUMERATOR_REGISTERED if is_registered else TAX_NUMERATOR_UNREGISTERED
+    remainder2 = (amount * tax_numerator * rate_bp) % (TAX_DENOMINATOR * RATE_BP_SCALE) * 2
+    return remainder2 == TAX_DENOMINATOR * RATE_BP_SCALE
+
+
+def test_rate_table_matches_baseline_rates():
+    for rank, by_key in BASELINE_RANK_RATES.items():
+        for key, rate in by_key.items():
+            assert RANK_RATE_BP[rank][key] == round(rate * RATE_BP_SCALE)
+
+
+@pytest.mark.parametrize("is_registered", [True, False])
+@pytest.mark.parametrize("rate_bp, rate", RATE_CASES)
+def test_fixed_point_matches_baseline_except_half_ties(rate_bp, rate, is_registered):
+    for amount in AMOUNTS:
+        exact = fixed_point_payout(amount, rate_bp, is_registered)
+        legacy = baseline_payout(amount, rate, is_registered)
+        if is_half_tie(amount, rate_bp, is_registered):
+            # .5 ちょうどは half_up で切り上げ、従来の round() は偶数丸め・浮動小数点誤差で切り下がり得る
+            assert exact - legacy in (0, 1), amount
+        else:
+            assert exact == legacy, amount
+
+
+@pytest.mark.parametrize("is_registered", [True, False])
+@pytest.mark.parametrize("rate_bp, rate", RATE_CASES)
+def test_vectorized_matches_scalar(rate_bp, rate, is_registered):
+    amounts = np.array(AMOUNTS, dtype=np.int64)
+    payouts = vectorized_payouts(amounts, rate_bp, np.full(amounts.shape, is_registered))
+    assert list(payouts) == [fixed_point_payout(int(a), rate_bp, is_registered) for a in amounts]
+
+
+@pytest.mark.parametrize("amount, rate_bp, rate, is_registered, half_up, legacy", [
+    # プレミアムライブ (登録者): 5 × 0.9 = 4.5
+    (5, PAID_LIVE_RATE_BP, 0.9, True, 5, 4),
+    # 25 × 0.9 = 22.5
+    (25, PAID_LIVE_RATE_BP, 0.9, True, 23, 22),
+    # 15 × 0.9 = 13.5 (従来は浮動小数点誤差で 13.4999... となり切り下がる)
+    (15, PAID_LIVE_RATE_BP, 0.9, True, 14, 13),
+    # ルーム売上 D/MK1 (登録者): 2 × 0.75 = 1.5 (従来の round() でも偶数の 2)
+    (2, RANK_RATE_BP['D'][1], 0.75, True, 2, 2),
+    # 6 × 0.75 = 4.5
+    (6, RANK_RATE_BP['D'][1], 0.75, True, 5, 4),
+])
+def test_half_ties_round_up(amount, rate_bp, rate, is_registered, half_up, legacy):
+    assert is_half_tie(amount, rate_bp, is_registered)
+    assert fixed_point_payout(amount, rate_bp, is_registered) == half_up
+    assert fixed_point_payout(amount, rate_bp, is_registered, rounding='down') == half_up - 1
+    assert baseline_payout(amount, rate, is_registered) == legacy
+
+
+def test_half_even_rounding_option():
+    assert fixed_point_payout(5, PAID_LIVE_RATE_BP, True, rounding='half_even') == 4
+    assert fixed_point_payout(15, PAID_LIVE_RATE_BP, True, rounding='half_even') == 14
+    with pytest.raises(ValueError):
+        fixed_point_payout(5, PAID_LIVE_RATE_BP, True, rounding='ceil')
+
+
+def test_vectorized_marks_invalid_rows_as_na():
+    payouts = vectorized_payouts(
+        pd.Series([1000, np.nan, 10.5, 2000]),
+        TIME_CHARGE_RATE_BP,
+        pd.Series([True, True, True, 'False']),
+        valid=[True, True, True, False],
+    )
+    assert payouts[0] == 1000
+    assert all(pd.isna(payouts[i]) for i in (1, 2, 3))
+
+
+def test_calculate_functions_use_fixed_point_kernel():
+    for mk_rank, key in MK_RANK_RATE_KEY.items():
+        for rank in RANK_RATE_BP:
+            assert calculate_payment_estimate(rank, mk_rank, 12_346, 'False') == fixed_point_payout(12_346, RANK_RATE_BP[rank][key], False)
+    assert calculate_paid_live_payment_estimate(5, True) == 5
+    assert calculate_time_charge_payment_estimate(1_234, False) == fixed_point_payout(1_234, TIME_CHARGE_RATE_BP, False)
+
+
+def test_calculate_functions_keep_error_markers():
+    assert calculate_payment_estimate('#N/A', 1, 1000, True) == "#N/A"
+    assert calculate_payment_estimate('D', 12, 1000, True) == "#ERROR_MK"
+    assert calculate_payment_estimate('Z', 1, 1000, True) == "#ERROR_RANK"
+    assert calculate_payment_estimate('D', 1, 10.5, True) == "#ERROR_CALC"
+    assert pd.isna(calculate_paid_live_payment_estimate(np.nan, True))
+    assert pd.isna(calculate_time_charge_payment_estimate(None, True))
@@ -0,0 +1,132 @@
+import threading
+import time
+
+import pytest
+
+from streamlit_app import SingleFlightCache
+
+
+def _run_concurrently(n, target):
+    """n 本のスレッドで target(i) を同時に開始し、全ての終了を待つ"""
+    barrier = threading.Barrier(n)
+
+    def worker(i):
+        barrier.wait()
+        target(i)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=10)
+
+
+def test_concurrent_callers_share_one_computation():
+    cache = SingleFlightCache(ttl_seconds=60)
+    calls = []
+    results = [None] * 20
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return "value"
+
+    def call(i):
+        results[i] = cache.get_or_compute("key", compute)
+
+    _run_concurrently(20, call)
+
+    assert len(calls) == 1
+    assert all(value == "value" for value, _ in results)
+    # 実際に取得した1件 (リーダー) 以外は、共有された結果を受け取る
+    assert sorted(shared for _, shared in results) == [False] + [True] * 19
+
+
+def test_different_keys_are_computed_separately():
+    cache = SingleFlightCache(ttl_seconds=60)
+    assert cache.get_or_compute("a", lambda: 1) == (1, False)
+    assert cache.get_or_compute("b", lambda: 2) == (2, False)
+    assert cache.get_or_compute("a", lambda: 3) == (1, True)
+
+
+def test_none_is_shared_with_waiters_but_not_cached():
+    cache = SingleFlightCache(ttl_seconds=60)
+    calls = []
+    results = [None] * 5
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return None
+
+    def call(i):
+        results[i] = cache.get_or_compute("key", compute)
+
+    _run_concurrently(5, call)
+
+    assert len(calls) == 1
+    assert all(value is None for value, _ in results)
+    # 取得失敗 (None) はキャッシュされず、次の呼び出しで取得し直す
+    assert cache.get_or_compute("key", lambda: "retried") == ("retried", False)
+
+
+def test_exception_is_raised_to_waiters_but_not_cached():
+    cache = SingleFlightCache(ttl_seconds=60)
+    calls = []
+    errors = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        raise RuntimeError("fetch failed")
+
+    def call(i):
+        try:
+            cache.get_or_compute("key", compute)
+        except RuntimeError as e:
+            errors.append(e)
+
+    _run_concurrently(5, call)
+
+    assert len(calls) == 1
+    assert len(errors) == 5
+    assert cache.get_or_compute("key", lambda: "retried") == ("retried", False)
+
+
+def test_entries_expire_after_ttl():
+    cache = SingleFlightCache(ttl_seconds=0.2)
+    assert cache.get_or_compute("key", lambda: "first") == ("first", False)
+    assert cache.get_or_compute("key", lambda: "second") == ("first", True)
+    time.sleep(0.3)
+    assert cache.get_or_compute("key", lambda: "second") == ("second", False)
+
+
+def test_invalidate_forces_recompute():
+    cache = SingleFlightCache(ttl_seconds=60)
+    cache.get_or_compute("key", lambda: "first")
+    cache.invalidate("key")
+    assert cache.get_or_compute("key", lambda: "second") == ("second", False)
+
+
+@pytest.mark.parametrize("n_keys", [1, 3])
+def test_fetch_count_matches_number_of_keys(n_keys):
+    cache = SingleFlightCache(ttl_seconds=60)
+    calls = []
+    results = [None] * 12
+    lock = threading.Lock()
+
+    def call(i):
+        key = i % n_keys
+
+        def compute():
+            with lock:
+                calls.append(key)
+            time.sleep(0.2)
+            return f"result:{key}"
+
+        results[i] = cache.get_or_compute(key, compute)[0]
+
+    _run_concurrently(12, call)
+
+    assert sorted(calls) == list(range(n_keys))
+    assert results == [f"result:{i % n_keys}" for i in range(12)]